@@ -1,12 +1,42 @@
 #!/usr/bin/env python2
 
 import argparse
+import contextlib
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import fnmatch
+import glob
+import gzip
+import hashlib
+import httplib
 import imp
+import json
+import marshal
+import multiprocessing
 import os
 import re
 import subprocess
 import shutil
+import signal
+import socket
+import SocketServer
+import stat as stat_module
+import struct
 import sys
+import tarfile
+import threading
+import time
+import urllib2
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 # Imported in main
 config = None
@@ -21,36 +51,1082 @@ class colors:
 
 
 def printc(m, c):
-    print c + m + colors.DEFAULT
+    output.message(m, c, False)
 
 
 def print_msg(m, color=colors.DEFAULT):
-    printc("========== %s ==========" % m, color)
+    output.message(m, color)
+
+
+class Output:
+    """Writes everything archutil reports to stdout. The text format prints
+    records as plain lines and messages in color. The json and jsonl formats
+    write each record and message as a JSON object as soon as it's produced,
+    as the elements of one array or one object per line."""
+    FORMATS = ('text', 'json', 'jsonl')
+    LEVELS = {colors.RED: 'error', colors.YELLOW: 'warning'}
+
+    def __init__(self, format='text'):
+        self.format = format
+        self.count = 0
+
+    def message(self, m, color=colors.DEFAULT, banner=True):
+        if self.format == 'text':
+            if banner:
+                m = "========== %s ==========" % m
+            print color + m + colors.DEFAULT
+        else:
+            self.write({'type': 'message', 'message': m,
+                        'level': self.LEVELS.get(color, 'info')})
+
+    def record(self, record_type, text, **fields):
+        """Writes a record, printed as `text` in the text format (if it isn't
+        None) or as `fields` in the JSON formats"""
+        if self.format == 'text':
+            if text is not None:
+                print text
+        else:
+            fields['type'] = record_type
+            self.write(fields)
+
+    def write(self, obj):
+        line = json.dumps(to_unicode(obj), sort_keys=True)
+        if self.format == 'json':
+            line = ('[' if self.count == 0 else ',') + line
+        sys.stdout.write(line + '\n')
+        sys.stdout.flush()
+        self.count += 1
+
+    def close(self):
+        if self.format == 'json':
+            sys.stdout.write('[]\n' if self.count == 0 else ']\n')
+        self.count = 0
+
+output = Output()
+
+
+def to_unicode(value):
+    """Recursively decodes the byte strings in `value`, replacing anything
+    that isn't valid UTF-8 so it can always be written as JSON"""
+    if isinstance(value, str):
+        return value.decode('utf-8', 'replace')
+    if isinstance(value, dict):
+        return dict((to_unicode(k), to_unicode(v))
+                    for k, v in value.iteritems())
+    if isinstance(value, (list, tuple)):
+        return [to_unicode(v) for v in value]
+    return value
+
+
+class PipelineCancelled(Exception):
+    """Raised when starting a process after the Pipeline was cancelled"""
+
+
+class ProcessRegistry:
+    """Tracks running child processes so a cancelled Pipeline can terminate
+    them"""
+
+    def __init__(self):
+        self.processes = set()
+        self.cancelled = False
+        self.lock = threading.Lock()
+
+    def popen(self, command, **kwargs):
+        with self.lock:
+            if self.cancelled:
+                raise PipelineCancelled()
+            p = subprocess.Popen(command, **kwargs)
+            self.processes.add(p)
+            return p
+
+    def done(self, p):
+        with self.lock:
+            self.processes.discard(p)
+
+    def terminate(self):
+        with self.lock:
+            self.cancelled = True
+            for p in self.processes:
+                try:
+                    p.terminate()
+                except OSError:
+                    # Already exited
+                    pass
+
+    def reset(self):
+        with self.lock:
+            self.cancelled = False
+
+processes = ProcessRegistry()
+
+
+class Tracer:
+    """Records the wall time of handler phases and subprocess calls. Nothing
+    is recorded unless `enabled` is set by --timings or --trace."""
+
+    def __init__(self):
+        self.enabled = False
+        self.events = []
+        self.lock = threading.Lock()
+        self.start = time.time()
+
+    def record(self, category, name, start, end, **args):
+        if not self.enabled:
+            return
+        event = {'cat': category, 'name': name, 'start': start, 'end': end,
+                 'tid': threading.current_thread().ident, 'args': args}
+        with self.lock:
+            self.events.append(event)
+
+    def record_command(self, command, start, returncode, output_size=None):
+        self.record('subprocess', ' '.join(command), start, time.time(),
+                    command=command, exit_code=returncode,
+                    output_bytes=output_size)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record('phase', name, start, time.time())
+
+    def call(self, func, command, **kwargs):
+        """Runs `func(command, **kwargs)`, where `func` is one of the
+        subprocess module's call, check_call or check_output"""
+        start = time.time()
+        returncode, output_size = None, None
+        try:
+            result = func(command, **kwargs)
+            if isinstance(result, str):
+                returncode, output_size = 0, len(result)
+            else:
+                returncode = result
+            return result
+        except subprocess.CalledProcessError as e:
+            returncode = e.returncode
+            if e.output is not None:
+                output_size = len(e.output)
+            raise
+        finally:
+            self.record_command(command, start, returncode, output_size)
+
+    def communicate(self, command, **kwargs):
+        """Runs `command` with its stdout captured and returns its return
+        code and output"""
+        start = time.time()
+        p = processes.popen(command, stdout=subprocess.PIPE, **kwargs)
+        try:
+            output, _ = p.communicate()
+        finally:
+            processes.done(p)
+        self.record_command(command, start, p.returncode, len(output))
+        return p.returncode, output
+
+    def command_key(self, command):
+        """Returns the program and options of `command`, leaving out operands
+        like file and package names"""
+        programs = [os.path.basename(command[0])]
+        if programs[0] == 'sudo' and len(command) > 1:
+            programs.append(os.path.basename(command[1]))
+        options = [a for a in command[len(programs):] if a.startswith('-')]
+        return ' '.join(programs + options)
+
+    def print_summary(self):
+        """Prints every phase, and the subprocess calls grouped by program and
+        first argument, to stderr"""
+        rows = []
+        commands = {}
+        for e in sorted(self.events, key=lambda e: e['start']):
+            if e['cat'] == 'phase':
+                rows.append((e['name'], 1, e['end'] - e['start'], '', ''))
+                continue
+            key = self.command_key(e['args']['command'])
+            if key not in commands:
+                commands[key] = [key, 0, 0.0, set(), 0]
+                rows.append(commands[key])
+            c = commands[key]
+            c[1] += 1
+            c[2] += e['end'] - e['start']
+            c[3].add(e['args']['exit_code'])
+            c[4] += e['args']['output_bytes'] or 0
+
+        out = sys.stderr
+        out.write('%-40s %6s %10s %10s %10s\n'
+                  % ('phase / command', 'calls', 'wall', 'exit', 'output'))
+        for name, calls, wall, exit_codes, output_bytes in rows:
+            if isinstance(exit_codes, set):
+                exit_codes = ','.join(str(c) for c in sorted(exit_codes))
+            out.write('%-40s %6d %9.3fs %10s %10s\n'
+                      % (name[:40], calls, wall, exit_codes, output_bytes))
+        out.write('%-40s %6s %9.3fs\n' % ('total', '', time.time() - self.start))
+
+    def write_trace(self, path):
+        """Writes the events in the Chrome trace event format, which can be
+        loaded in chrome://tracing or Perfetto"""
+        pid = os.getpid()
+        events = [{'name': e['name'], 'cat': e['cat'], 'ph': 'X',
+                   'ts': int((e['start'] - self.start) * 1e6),
+                   'dur': int((e['end'] - e['start']) * 1e6),
+                   'pid': pid, 'tid': e['tid'], 'args': e['args']}
+                  for e in self.events]
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+
+tracer = Tracer()
+
+
+class PipelineFailed(Exception):
+    """Raised by a Pipeline step to stop the pipeline, with the message to
+    report"""
+
+
+class Pipeline:
+    """Runs steps concurrently, each in its own thread as soon as the steps it
+    depends on have finished. The first step to fail cancels the pipeline:
+    steps that haven't started are skipped and the processes started through
+    `processes` are terminated."""
+
+    def __init__(self):
+        self.steps = []
+
+    def add(self, name, func, deps=()):
+        """Adds a step calling `func` with the results of `deps`"""
+        self.steps.append((name, func, deps))
+
+    def run(self):
+        """Runs the steps and returns a dict of their results. The exception
+        of the step that failed first is raised once all steps stopped."""
+        done = dict((name, threading.Event()) for name, _, _ in self.steps)
+        results = {}
+        errors = []
+        cancelled = threading.Event()
+
+        def cancel(error):
+            if not cancelled.is_set():
+                errors.append(error)
+                cancelled.set()
+                processes.terminate()
+
+        def run_step(name, func, deps):
+            try:
+                for dep in deps:
+                    done[dep].wait()
+                if cancelled.is_set():
+                    return
+                with tracer.phase(name):
+                    results[name] = func(*[results[dep] for dep in deps])
+            except BaseException:
+                # Steps failing because they were cancelled aren't reported
+                cancel(sys.exc_info())
+            finally:
+                done[name].set()
+
+        threads = [threading.Thread(target=run_step, args=step)
+                   for step in self.steps]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        try:
+            for t in threads:
+                # Join with a timeout so Ctrl-C still reaches the main thread
+                while t.is_alive():
+                    t.join(0.1)
+        except KeyboardInterrupt:
+            cancel(sys.exc_info())
+            raise
+        finally:
+            processes.reset()
+
+        if errors:
+            raise errors[0][0], errors[0][1], errors[0][2]
+        return results
+
+
+def get_cache_dir():
+    cache_home = os.environ.get('XDG_CACHE_HOME',
+                                os.path.expanduser('~/.cache'))
+    return os.path.join(cache_home, 'archutil')
+
+
+def get_cache_path(prefix, path):
+    """Returns the path of the cache file called `prefix` kept for `path`"""
+    key = hashlib.sha1(os.path.abspath(path)).hexdigest()
+    return os.path.join(get_cache_dir(), '%s-%s' % (prefix, key[:16]))
+
+
+def load_cache(path, version):
+    """Returns the data stored in the cache file at `path`, or None if the
+    file is missing, unreadable or was written with a different `version`"""
+    try:
+        with open(path, 'rb') as f:
+            cached_version, data = marshal.load(f)
+    except (IOError, EOFError, ValueError, TypeError):
+        return None
+    if cached_version != version:
+        return None
+    return data
+
+
+def save_cache(path, version, data):
+    """Atomically writes `data` to the cache file at `path`. Caches are only
+    an optimization, so failing to write one is not an error."""
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(tmp_path, 'wb') as f:
+            marshal.dump((version, data), f)
+        os.rename(tmp_path, path)
+    except (IOError, OSError, ValueError):
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def parallel_imap(func, items, jobs):
+    """Yields `func(item)` for each of `items` in order, computing up to `jobs`
+    results ahead of the caller in daemon threads. Unlike ThreadPool this
+    doesn't add a polling delay on shutdown, and workers stop picking up items
+    once the caller stops iterating."""
+    items = list(items)
+    if jobs <= 1 or len(items) <= 1:
+        for item in items:
+            yield func(item)
+        return
+
+    results = {}
+    # `yielded` counts the results handed to the caller, and no item more
+    # than `jobs` past it is started
+    state = {'next': 0, 'yielded': 0, 'stopped': False}
+    cond = threading.Condition()
+
+    def worker():
+        while True:
+            with cond:
+                while (not state['stopped'] and state['next'] < len(items)
+                       and state['next'] >= state['yielded'] + jobs):
+                    cond.wait()
+                if state['stopped'] or state['next'] >= len(items):
+                    return
+                i = state['next']
+                state['next'] += 1
+            try:
+                result = (True, func(items[i]))
+            except Exception:
+                result = (False, sys.exc_info())
+            with cond:
+                results[i] = result
+                cond.notify_all()
+
+    for _ in range(min(jobs, len(items))):
+        t = threading.Thread(target=worker)
+        t.daemon = True
+        t.start()
+
+    try:
+        for i in range(len(items)):
+            with cond:
+                # A timeout keeps the wait interruptible by Ctrl-C
+                while i not in results:
+                    cond.wait(1)
+                ok, value = results.pop(i)
+                state['yielded'] = i + 1
+                cond.notify_all()
+            if not ok:
+                raise value[0], value[1], value[2]
+            yield value
+    finally:
+        with cond:
+            state['stopped'] = True
+            cond.notify_all()
+
+
+DEFAULT_DBPATH = '/var/lib/pacman'
+
+
+def get_dbpath(root=None, dbpath=None):
+    """Returns the pacman database path, resolved the same way pacman resolves
+    its --root and --dbpath options"""
+    if dbpath is not None:
+        return dbpath
+    if root is not None:
+        return os.path.join(root, DEFAULT_DBPATH.lstrip('/'))
+    return DEFAULT_DBPATH
+
+
+def parse_db_desc(text):
+    """Parses a pacman database `desc` file into a dict mapping each %FIELD%
+    name to its list of values"""
+    fields = {}
+    values = None
+    for line in text.split('\n'):
+        if len(line) > 2 and line[0] == '%' and line[-1] == '%':
+            values = fields.setdefault(line[1:-1], [])
+        elif not line:
+            values = None
+        elif values is not None:
+            values.append(line)
+    return fields
+
+
+def strip_version(dep):
+    """Returns the package name of a dependency or provision like `sh>=4`"""
+    return re.split(r'[<>=]', dep, 1)[0]
+
+
+def get_sync_db_files(sync_dir, repos=None):
+    """Returns the sync database files in `sync_dir`, only those of `repos` if
+    it's given"""
+    if not os.path.isdir(sync_dir):
+        return []
+    return [os.path.join(sync_dir, f)
+            for f in sorted(os.listdir(sync_dir)) if f.endswith('.db')
+            and (repos is None or f[:-len('.db')] in repos)]
+
+
+DEFAULT_PACMAN_CONF = '/etc/pacman.conf'
+
+PACMAN_CONF_SECTION_RE = re.compile(r'^\[([^\]]+)\]$')
+# Repos are usually disabled by commenting out their section header
+PACMAN_CONF_DISABLED_SECTION_RE = re.compile(r'^#\s*\[([^\]]+)\]\s*$')
+
+
+class PacmanConfig:
+    """Model of pacman.conf and the files it includes. The parsed options and
+    repos are cached on disk until the mtime of one of the files read, or of
+    a directory an Include pattern was expanded in, changes."""
+    CACHE_VERSION = 1
+
+    def __init__(self, path=DEFAULT_PACMAN_CONF, cache_path=None):
+        self.path = path
+        if cache_path is None:
+            cache_path = get_cache_path('pacman-conf', path)
+        self.cache_path = cache_path
+        # Maps each option in [options] to its list of values
+        self.options = {}
+        # (name, enabled) for every repo section, in the order they appear
+        self.repos = []
+        self.mtimes = {}
+        self.load()
+
+    def load(self):
+        cache = load_cache(self.cache_path, self.CACHE_VERSION)
+        if cache is not None and self.is_fresh(cache['mtimes']):
+            self.options, self.repos = cache['options'], cache['repos']
+            self.mtimes = cache['mtimes']
+            return
+
+        self.parse(self.path, None)
+        save_cache(self.cache_path, self.CACHE_VERSION,
+                   {'mtimes': self.mtimes, 'options': self.options,
+                    'repos': self.repos})
+
+    def is_fresh(self, mtimes):
+        for path, mtime in mtimes.iteritems():
+            try:
+                if os.stat(path).st_mtime != mtime:
+                    return False
+            except OSError:
+                if mtime is not None:
+                    return False
+        return True
+
+    def record_mtime(self, path):
+        try:
+            self.mtimes[path] = os.stat(path).st_mtime
+        except OSError:
+            self.mtimes[path] = None
+
+    def parse(self, path, section):
+        """Parses `path` starting in `section`, the way pacman reads Included
+        files, and returns the section it ends in"""
+        self.record_mtime(path)
+        try:
+            with open(path) as f:
+                lines = f.read().split('\n')
+        except IOError:
+            return section
+
+        for line in lines:
+            line = line.strip()
+            match = PACMAN_CONF_DISABLED_SECTION_RE.match(line)
+            if match is not None and match.group(1) != 'options':
+                self.add_repo(match.group(1), False)
+                continue
+            line = line.split('#', 1)[0].strip()
+            if not line:
+                continue
+            match = PACMAN_CONF_SECTION_RE.match(line)
+            if match is not None:
+                section = match.group(1)
+                if section != 'options':
+                    self.add_repo(section, True)
+                continue
+
+            key, _, value = line.partition('=')
+            key, value = key.strip(), value.strip()
+            if key == 'Include':
+                if is_pattern(value):
+                    # Files added to the directory change what's included
+                    self.record_mtime(os.path.dirname(value))
+                for include in sorted(glob.glob(value)) or [value]:
+                    self.parse(include, section)
+            elif section == 'options':
+                self.options.setdefault(key, []).extend(value.split())
+        return section
+
+    def add_repo(self, name, enabled):
+        for i, (repo, repo_enabled) in enumerate(self.repos):
+            if repo == name:
+                self.repos[i] = (repo, repo_enabled or enabled)
+                return
+        self.repos.append((name, enabled))
+
+    def enabled_repos(self):
+        return [name for name, enabled in self.repos if enabled]
+
+    def get(self, option, default=None):
+        values = self.options.get(option)
+        return values[0] if values else default
+
+    @property
+    def root_dir(self):
+        return self.get('RootDir')
+
+    @property
+    def dbpath(self):
+        # Like pacman, DBPath defaults to a path under RootDir
+        return self.get('DBPath') or get_dbpath(self.root_dir)
+
+    @property
+    def cache_dirs(self):
+        return self.options.get('CacheDir') or [DEFAULT_CACHE_DIR]
+
+    @property
+    def logfile(self):
+        return self.get('LogFile') or get_logfile(self.root_dir)
+
+
+class Package(object):
+    """A single package entry read from a pacman database"""
+    __slots__ = ('name', 'version', 'explicit', 'groups', 'depends',
+                 'provides')
+
+    def __init__(self, name, version, explicit, groups, depends=(),
+                 provides=()):
+        self.name = name
+        self.version = version
+        self.explicit = explicit
+        self.groups = groups
+        self.depends = depends
+        self.provides = provides
+
+    @classmethod
+    def from_desc(cls, text):
+        fields = parse_db_desc(text)
+        # %REASON% is only written for packages installed as a dependency
+        return cls(fields['NAME'][0], fields['VERSION'][0],
+                   fields.get('REASON', ['0'])[0] == '0',
+                   frozenset(fields.get('GROUPS', [])),
+                   tuple(strip_version(d) for d in fields.get('DEPENDS', [])),
+                   tuple(strip_version(p) for p in fields.get('PROVIDES', [])))
+
+
+class LocalPackageDB:
+    """Index of the packages installed in a pacman local database, built from
+    one scan of `<dbpath>/local/*/desc` instead of `pacman -Q` calls"""
+
+    def __init__(self, dbpath=DEFAULT_DBPATH):
+        self.dbpath = dbpath
+        self.packages = {}
+        self.providers = None
+        self.required_by = None
+        self.load()
+
+    def load(self):
+        local_dir = os.path.join(self.dbpath, 'local')
+        for entry in os.listdir(local_dir):
+            desc_path = os.path.join(local_dir, entry, 'desc')
+            # local/ also contains the ALPM_DB_VERSION file
+            if not os.path.isfile(desc_path):
+                continue
+            with open(desc_path) as f:
+                package = Package.from_desc(f.read())
+            self.packages[package.name] = package
+
+    def explicit_packages(self):
+        """Returns the set of explicitly installed packages"""
+        return set(p.name for p in self.packages.itervalues() if p.explicit)
+
+    def groups(self):
+        """Returns the set of groups that have at least one installed member"""
+        groups = set()
+        for p in self.packages.itervalues():
+            groups.update(p.groups)
+        return groups
+
+    def group_members(self, groups):
+        """Returns the set of installed packages belonging to any of `groups`"""
+        groups = set(groups)
+        return set(p.name for p in self.packages.itervalues()
+                   if not groups.isdisjoint(p.groups))
+
+    def resolve(self, dep):
+        """Returns the installed package satisfying the dependency `dep`, or
+        None if it isn't satisfied"""
+        if dep in self.packages:
+            return dep
+        if self.providers is None:
+            self.providers = {}
+            for p in self.packages.itervalues():
+                for provision in p.provides:
+                    self.providers.setdefault(provision, p.name)
+        return self.providers.get(dep)
+
+    def reverse_dependencies(self):
+        """Returns a dict mapping each installed package to the set of
+        installed packages that depend on it"""
+        if self.required_by is None:
+            self.required_by = dict((name, set()) for name in self.packages)
+            for p in self.packages.itervalues():
+                for dep in p.depends:
+                    target = self.resolve(dep)
+                    if target is not None:
+                        self.required_by[target].add(p.name)
+        return self.required_by
+
+    def dependency_closure(self, packages):
+        """Returns the set of installed packages that `packages` depend on,
+        directly or indirectly, not including `packages` themselves unless
+        there's a dependency cycle"""
+        closure = set()
+        stack = [self.resolve(d) for name in packages if name in self.packages
+                 for d in self.packages[name].depends]
+        while stack:
+            name = stack.pop()
+            if name is None or name in closure:
+                continue
+            closure.add(name)
+            stack.extend(self.resolve(d) for d in self.packages[name].depends)
+        return closure
+
+
+DEFAULT_LOGFILE = '/var/log/pacman.log'
+
+# Matches the transaction lines libalpm writes to pacman.log, with or without
+# the [ALPM] tag older versions didn't write
+LOG_LINE_RE = re.compile(r'^\[[^\]]*\] (?:\[ALPM\] )?(installed|removed|upgraded|'
+                         r'downgraded|reinstalled) (\S+) \(([^)]*)\)$')
+
+
+def get_logfile(root=None):
+    if root is not None:
+        return os.path.join(root, DEFAULT_LOGFILE.lstrip('/'))
+    return DEFAULT_LOGFILE
+
+
+def parse_log_lines(text):
+    """Yields (action, name, version) for the package transactions in pacman.log
+    lines. `version` is the version installed by the transaction, or the one
+    removed for removals."""
+    for line in text.splitlines():
+        match = LOG_LINE_RE.match(line)
+        if match is not None:
+            action, name, version = match.groups()
+            yield action, name, version.split(' -> ')[-1]
+
+
+class IncrementalLocalPackageDB(LocalPackageDB):
+    """LocalPackageDB that keeps a snapshot of the index on disk together with
+    the offset it last read in pacman.log. Later loads only reread the `desc`
+    files of packages the new log lines mention, and everything is rescanned if
+    the log was rotated or truncated.
+
+    Changes pacman doesn't log, like `pacman -D` changing an install reason,
+    aren't seen until the next rescan."""
+    CACHE_VERSION = 1
+
+    def __init__(self, dbpath=DEFAULT_DBPATH, logfile=DEFAULT_LOGFILE,
+                 cache_path=None):
+        self.logfile = logfile
+        if cache_path is None:
+            cache_path = get_cache_path('local', dbpath)
+        self.cache_path = cache_path
+        self.rescanned = False
+        LocalPackageDB.__init__(self, dbpath)
+
+    def load(self):
+        snapshot = load_cache(self.cache_path, self.CACHE_VERSION)
+        try:
+            # Read before the database, so transactions made while it's being
+            # read are applied again next time rather than missed
+            st = os.stat(self.logfile)
+        except OSError:
+            self.rescanned = True
+            return LocalPackageDB.load(self)
+
+        if (snapshot is None or snapshot['inode'] != st.st_ino
+                or st.st_size < snapshot['offset']):
+            self.rescan(st.st_ino, st.st_size)
+            return
+
+        self.packages = dict(
+            (name, Package(name, *fields))
+            for name, fields in snapshot['packages'].iteritems())
+        if st.st_size == snapshot['offset']:
+            return
+        with open(self.logfile) as f:
+            f.seek(snapshot['offset'])
+            data = f.read(st.st_size - snapshot['offset'])
+        # Leave a partly written last line for the next run
+        data = data[:data.rfind('\n') + 1]
+        if not self.apply_log(data):
+            self.rescan(st.st_ino, st.st_size)
+            return
+        self.save(st.st_ino, snapshot['offset'] + len(data))
+
+    def apply_log(self, text):
+        """Applies the transactions in `text` to the index, returning False if
+        the database doesn't match the log"""
+        local_dir = os.path.join(self.dbpath, 'local')
+        touched = {}
+        for action, name, version in parse_log_lines(text):
+            touched[name] = None if action == 'removed' else version
+        for name, version in touched.iteritems():
+            if version is None:
+                self.packages.pop(name, None)
+                continue
+            desc_path = os.path.join(local_dir, '%s-%s' % (name, version),
+                                     'desc')
+            try:
+                with open(desc_path) as f:
+                    self.packages[name] = Package.from_desc(f.read())
+            except IOError:
+                return False
+        return True
+
+    def rescan(self, inode, offset):
+        self.rescanned = True
+        self.packages = {}
+        LocalPackageDB.load(self)
+        self.save(inode, offset)
+
+    def save(self, inode, offset):
+        packages = dict(
+            (p.name, (p.version, p.explicit, p.groups, p.depends, p.provides))
+            for p in self.packages.itervalues())
+        save_cache(self.cache_path, self.CACHE_VERSION,
+                   {'inode': inode, 'offset': offset, 'packages': packages})
+
+
+class SyncPackageDB:
+    """Index of the package names, groups and provisions in the pacman sync
+    databases, read from the `<dbpath>/sync/*.db` tarballs. The index is cached
+    on disk per database file and only rebuilt for files whose mtime or size
+    changed since the cache was written."""
+    CACHE_VERSION = 1
+
+    def __init__(self, dbpath=DEFAULT_DBPATH, cache_path=None, repos=None):
+        self.sync_dir = os.path.join(dbpath, 'sync')
+        self.repos = repos
+        if cache_path is None:
+            cache_path = get_cache_path('sync', self.sync_dir)
+        self.cache_path = cache_path
+        self.names = set()
+        self.groups = set()
+        self.provides = set()
+        self.load()
+
+    def db_files(self):
+        return get_sync_db_files(self.sync_dir, self.repos)
+
+    def load(self):
+        cache = load_cache(self.cache_path, self.CACHE_VERSION) or {}
+        entries = {}
+        for path in self.db_files():
+            st = os.stat(path)
+            key = (st.st_mtime, st.st_size)
+            if path not in cache or cache[path][0] != key:
+                entries[path] = (key, self.read_db(path))
+            else:
+                entries[path] = cache[path]
+
+            names, groups, provides = entries[path][1]
+            self.names.update(names)
+            self.groups.update(groups)
+            self.provides.update(provides)
+
+        if set(entries) != set(cache) or any(
+                entries[p][0] != cache[p][0] for p in entries):
+            save_cache(self.cache_path, self.CACHE_VERSION, entries)
+
+    def read_db(self, path):
+        """Returns the sets of package names, groups and provisions in the
+        sync database at `path`"""
+        names, groups, provides = set(), set(), set()
+        with tarfile.open(path) as tar:
+            for member in tar:
+                # Older databases keep %PROVIDES% in a separate `depends` file
+                if (not member.isfile() or os.path.basename(member.name)
+                        not in ('desc', 'depends')):
+                    continue
+                fields = parse_db_desc(tar.extractfile(member).read())
+                names.update(fields.get('NAME', []))
+                groups.update(fields.get('GROUPS', []))
+                provides.update(strip_version(p)
+                                for p in fields.get('PROVIDES', []))
+        return frozenset(names), frozenset(groups), frozenset(provides)
+
+    def contains(self, name):
+        """Returns whether `name` can be installed with `pacman -S`"""
+        return (name in self.names or name in self.groups
+                or name in self.provides)
+
+
+class AURSnapshot:
+    """Index of the package names and provisions in a locally stored AUR
+    metadata dump. Both the JSON `packages-meta-v1.json(.gz)` format and the
+    plain `packages(.gz)` name list are supported, and the parsed index is
+    cached on disk until the dump changes."""
+    CACHE_VERSION = 1
+
+    def __init__(self, path, cache_path=None):
+        self.path = path
+        if cache_path is None:
+            cache_path = get_cache_path('aur', path)
+        self.cache_path = cache_path
+        self.names = set()
+        self.provides = set()
+        self.load()
+
+    def load(self):
+        st = os.stat(self.path)
+        key = (st.st_mtime, st.st_size)
+        cache = load_cache(self.cache_path, self.CACHE_VERSION)
+        if cache is not None and cache[0] == key:
+            names, provides = cache[1]
+        else:
+            names, provides = self.read_snapshot()
+            save_cache(self.cache_path, self.CACHE_VERSION,
+                       (key, (names, provides)))
+        self.names.update(names)
+        self.provides.update(provides)
+
+    def read_snapshot(self):
+        opener = gzip.open if self.path.endswith('.gz') else open
+        with opener(self.path, 'rb') as f:
+            data = f.read()
+
+        if not data.lstrip().startswith('['):
+            names = set(l.strip() for l in data.split('\n')
+                        if l.strip() and not l.startswith('#'))
+            return frozenset(names), frozenset()
+
+        names, provides = set(), set()
+        for package in json.loads(data):
+            names.add(str(package['Name']))
+            provides.update(str(strip_version(p))
+                            for p in package.get('Provides') or [])
+        return frozenset(names), frozenset(provides)
+
+    def contains(self, name):
+        return name in self.names or name in self.provides
+
+
+class AURResolver:
+    """Checks whether packages that aren't in the sync databases exist in the
+    AUR. All candidates are first looked up in one batch in an `AURSnapshot`,
+    and only the remaining ones are searched for with the AUR helper, using a
+    bounded pool of concurrent helper processes."""
+
+    def __init__(self, helper, snapshot_path=None, jobs=4):
+        self.helper = helper
+        self.snapshot_path = snapshot_path
+        self.jobs = jobs
+        self.snapshot = None
+        # Maps each resolved package to a (source, seconds) tuple
+        self.timings = {}
+
+    def get_snapshot(self):
+        """Returns the AURSnapshot, or None if there is none or it can't be
+        read, in which case every package is searched for with the helper"""
+        if self.snapshot is None and self.snapshot_path is not None:
+            try:
+                self.snapshot = AURSnapshot(self.snapshot_path)
+            except (IOError, OSError, EOFError, ValueError, KeyError,
+                    TypeError) as e:
+                printc('Failed to read the AUR snapshot %s, searching with '
+                       '%s instead: %s' % (self.snapshot_path, self.helper, e),
+                       colors.YELLOW)
+                self.snapshot_path = None
+        return self.snapshot
+
+    def helper_search(self, package):
+        """Returns (package, found, seconds) for a single helper search"""
+        start = time.time()
+        dev_null = open(os.devnull, 'w')
+        _, output = tracer.communicate([self.helper, '-Ssq', package],
+                                       stderr=dev_null)
+        found = package in output.split('\n')
+        return package, found, time.time() - start
+
+    def resolve(self, packages):
+        """Returns the sorted list of `packages` that couldn't be found"""
+        remaining = sorted(packages)
+
+        start = time.time()
+        snapshot = self.get_snapshot() if remaining else None
+        if snapshot is not None:
+            found = [p for p in remaining if snapshot.contains(p)]
+            elapsed = (time.time() - start) / max(len(remaining), 1)
+            for p in found:
+                self.timings[p] = ('snapshot', elapsed)
+            remaining = [p for p in remaining if not snapshot.contains(p)]
+
+        if not remaining:
+            return []
+
+        bad_packages = []
+        for package, found, elapsed in parallel_imap(self.helper_search,
+                                                     remaining, self.jobs):
+            self.timings[package] = (self.helper, elapsed)
+            if not found:
+                bad_packages.append(package)
+        return bad_packages
+
+
+DEFAULT_CACHE_DIR = '/var/cache/pacman/pkg'
+
+
+class Prefetcher:
+    """Downloads the packages an install is going to need into a package
+    cache, several at a time, so the install transaction doesn't have to
+    download them one after another.
+
+    pacman locks its database for -Sw, so concurrent -Sw batches would fail.
+    Instead the download URLs are resolved with one `pacman -Sp` call, which
+    doesn't take the lock, and fetched in parallel threads. If the pacman
+    cache isn't writable, packages are downloaded to a user cache directory
+    that's passed to the install with --cachedir.
+
+    A package that fails to download, or whose mirror stalls for `timeout`
+    seconds, is left for the install transaction to download itself."""
+
+    def __init__(self, cache_dirs=None, jobs=4, timeout=30):
+        if cache_dirs is None:
+            cache_dirs = [DEFAULT_CACHE_DIR]
+        self.cache_dirs = cache_dirs
+        self.jobs = jobs
+        self.timeout = timeout
+        self.download_dir = next(
+            (d for d in cache_dirs if os.access(d, os.W_OK)), None)
+        if self.download_dir is None:
+            self.download_dir = os.path.join(get_cache_dir(), 'pkg')
+        # Maps each downloaded file to a (bytes, seconds) tuple
+        self.timings = {}
+        # Maps each file that failed to download to the error
+        self.errors = {}
+
+    def get_urls(self, targets):
+        """Returns the download URLs of `targets` and the dependencies they
+        need that aren't installed or up to date"""
+        output = tracer.call(subprocess.check_output,
+                             ['pacman', '-Sp', '--needed', '--noconfirm',
+                              '--print-format', '%l'] + sorted(targets))
+        return [l for l in output.split('\n') if '://' in l]
+
+    def is_cached(self, filename):
+        return any(os.path.isfile(os.path.join(d, filename))
+                   for d in self.cache_dirs + [self.download_dir])
+
+    def download(self, url):
+        """Downloads `url` and returns the file name, its size and the time
+        taken, or the file name, None and the error if the download failed"""
+        start = time.time()
+        filename = os.path.basename(url)
+        path = os.path.join(self.download_dir, filename)
+        part_path = path + '.part'
+        size = 0
+        try:
+            response = urllib2.urlopen(url, timeout=self.timeout)
+            try:
+                with open(part_path, 'wb') as f:
+                    for chunk in iter(lambda: response.read(1 << 16), ''):
+                        f.write(chunk)
+                        size += len(chunk)
+            finally:
+                response.close()
+            os.rename(part_path, path)
+        except (IOError, OSError, httplib.HTTPException) as e:
+            if os.path.exists(part_path):
+                os.remove(part_path)
+            return filename, None, e
+        return filename, size, time.time() - start
+
+    def prefetch(self, targets):
+        """Downloads every package needed to install `targets` that isn't
+        already cached and returns the list of downloaded files"""
+        if not targets:
+            return []
+        urls = [u for u in self.get_urls(targets)
+                if not self.is_cached(os.path.basename(u))]
+        if not urls:
+            return []
+
+        if not os.path.isdir(self.download_dir):
+            os.makedirs(self.download_dir)
+        downloaded = []
+        for filename, size, elapsed in parallel_imap(self.download, urls,
+                                                     self.jobs):
+            if size is None:
+                self.errors[filename] = elapsed
+                continue
+            self.timings[filename] = (size, elapsed)
+            downloaded.append(filename)
+        return downloaded
+
+    def install_options(self):
+        """Returns the pacman options needed to use the prefetched files"""
+        if self.download_dir in self.cache_dirs:
+            return []
+        options = []
+        for d in self.cache_dirs + [self.download_dir]:
+            options.extend(['--cachedir', d])
+        return options
 
 
 class ListHandler:
+    def __init__(self, dbpath=DEFAULT_DBPATH, logfile=None):
+        self.dbpath = dbpath
+        self.logfile = logfile
+        self.index = None
+
+    def get_index(self):
+        if self.index is None:
+            with tracer.phase('load local index'):
+                if self.logfile is not None:
+                    self.index = IncrementalLocalPackageDB(self.dbpath,
+                                                           self.logfile)
+                else:
+                    self.index = LocalPackageDB(self.dbpath)
+        return self.index
+
     def get_listed_packages(self, packages, categories):
         """Returns a set of packages listed in `config.packages`"""
         return set([p for c in categories for p in packages[c]])
 
     def get_listed_groups(self, packages):
         """Returns a list of packages in `config.packages` that are actually
-        groups"""
-        # TODO: Clean this up by just using pacman -Sg
-        command = "pacman -Sg %s | awk '{print $1}' | sort -u" \
-                  % " ".join(packages)
-        return subprocess.check_output(command, shell=True).rstrip().split('\n')
+        groups. Only groups with installed members are found, but those are the
+        only ones that affect the installed package list."""
+        return list(self.get_index().groups().intersection(packages))
 
     def get_installed_packages(self, groups):
-        """Returns a set of installed packages"""
-        command = ("pacman -Qe | awk '{print $1}'"
-                   "| grep -Fxv -f <(pacman -Qg %s"
-                   "| awk '{print $2}')") % " ".join(groups)
-        packages = subprocess.check_output(
-            command, shell=True, executable="/bin/bash").rstrip().split('\n')
-        for i in range(0, len(packages)):
-            packages[i] = packages[i].split()[0]
-        return set(packages)
+        """Returns a set of explicitly installed packages that aren't members
+        of any of `groups`"""
+        index = self.get_index()
+        return index.explicit_packages() - index.group_members(groups)
 
     def get_differing_packages(self, categories, inverse):
         packages = self.get_listed_packages(config.packages, categories)
@@ -71,76 +1147,891 @@ class ListHandler:
         else:
             categories = config.packages.keys()
 
-        if not args.inverse:
-            # Print all packages that are installed but not listed in the script
-            diff = self.get_differing_packages(categories, False)
-        else:
-            # Packages listed in the script but not installed
-            diff = self.get_differing_packages(categories, True)
+        if args.deps:
+            with tracer.phase('dependency report'):
+                report = self.get_dependency_report(categories)
+            self.print_dependency_report(report)
+            return
 
-        diff.sort()
-        if args.list:
-            print "['" + "',\n'".join(diff) + "']"
+        with tracer.phase('get differing packages'):
+            if not args.inverse:
+                # Print all packages that are installed but not listed in the
+                # script
+                diff = self.get_differing_packages(categories, False)
+            else:
+                # Packages listed in the script but not installed
+                diff = self.get_differing_packages(categories, True)
+
+        if output.format == 'text':
+            print self.format_packages(diff, args.list)
+        else:
+            status = 'not installed' if args.inverse else 'not listed'
+            for package in sorted(diff):
+                output.record('package', None, name=package, status=status)
+
+    def format_packages(self, packages, as_list):
+        packages = sorted(packages)
+        if as_list:
+            return "['" + "',\n'".join(packages) + "']"
+        else:
+            return '\n'.join(packages)
+
+    def get_dependency_report(self, categories):
+        """Returns a dict with
+        - `redundant`: listed packages that other listed packages depend on
+        - `implied`: unlisted explicitly installed packages that are only
+          required by listed packages or their dependencies
+        - `orphans`: packages installed as dependencies that no explicitly
+          installed package needs
+        - `closures`: the installed dependency closure of each category
+        Every value maps a package or category to a sorted list of packages."""
+        index = self.get_index()
+        required_by = index.reverse_dependencies()
+
+        def installed_roots(packages):
+            packages = set(packages)
+            return ((packages & set(index.packages))
+                    | index.group_members(packages))
+
+        listed = installed_roots(
+            self.get_listed_packages(config.packages, categories))
+        dependencies = index.dependency_closure(listed)
+        wanted = listed | dependencies
+
+        redundant = dict((p, sorted(required_by[p] & wanted))
+                         for p in listed & dependencies)
+        implied = dict((p, sorted(required_by[p]))
+                       for p in index.explicit_packages() - listed
+                       if required_by[p] and required_by[p] <= wanted)
+
+        explicit = index.explicit_packages()
+        needed = explicit | index.dependency_closure(explicit)
+        orphans = dict((p, []) for p in set(index.packages) - needed)
+
+        closures = {}
+        for category in categories:
+            roots = installed_roots(config.packages[category])
+            closures[category] = sorted(
+                roots | index.dependency_closure(roots))
+
+        return {'redundant': redundant, 'implied': implied,
+                'orphans': orphans, 'closures': closures}
+
+    def print_dependency_report(self, report):
+        sections = [
+            ('redundant', 'Listed packages that are pulled in as dependencies',
+             'required by'),
+            ('implied', 'Unlisted packages only required by listed packages',
+             'required by'),
+            ('orphans', 'Dependencies no explicit package needs', None),
+        ]
+        for key, title, label in sections:
+            print_msg(title, colors.BLUE)
+            for package, packages in sorted(report[key].iteritems()):
+                if label is None:
+                    text = package
+                else:
+                    text = '%s (%s %s)' % (package, label, ', '.join(packages))
+                output.record('dependency', text, section=key, name=package,
+                              required_by=packages)
+
+        print_msg('Dependency closure per category', colors.BLUE)
+        for category, packages in sorted(report['closures'].iteritems()):
+            output.record('closure',
+                          '%s: %d packages' % (category, len(packages)),
+                          category=category, packages=packages)
+
+
+def stat_signature(path):
+    """Returns the (size, mtime, inode) of `path`, which changes whenever the
+    file's content may have changed"""
+    st = os.stat(path)
+    return (st.st_size, st.st_mtime, st.st_ino)
+
+
+def hash_file(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), ''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def hash_path(path):
+    """Returns the hash of a file, or of the relative paths and contents of
+    the files under a directory, or None if `path` doesn't exist"""
+    if os.path.isfile(path):
+        return hash_file(path)
+    if not os.path.isdir(path):
+        return None
+    h = hashlib.sha1()
+    for rel, st in sorted(scan_tree(path).iteritems()):
+        if stat_module.S_ISREG(st.st_mode):
+            h.update('%s\0%s\0' % (rel, hash_file(os.path.join(path, rel))))
+    return h.hexdigest()
+
+
+DEFAULT_MAX_DIFF_SIZE = 1 << 20
+
+
+def is_binary_file(path):
+    """Returns whether `path` looks binary, judging by a NUL byte in its first
+    few kilobytes like diff does"""
+    with open(path, 'rb') as f:
+        return '\0' in f.read(8192)
+
+
+def iter_diff_output(path1, path2):
+    """Yields the output of `diff path1 path2` in chunks as it's produced.
+    Binary files are reported without running diff."""
+    if any(os.path.isfile(p) and is_binary_file(p) for p in (path1, path2)):
+        yield 'Binary files %s and %s differ\n' % (path1, path2)
+        return
+
+    command = ['diff', path1, path2]
+    start = time.time()
+    size = 0
+    finished = False
+    p = subprocess.Popen(command, stdout=subprocess.PIPE)
+    try:
+        for chunk in iter(lambda: p.stdout.read(1 << 16), ''):
+            size += len(chunk)
+            yield chunk
+        finished = True
+    finally:
+        # The consumer may stop reading before diff is done
+        if not finished and p.poll() is None:
+            p.kill()
+        p.stdout.close()
+        tracer.record_command(command, start, p.wait(), size)
+
+
+def truncate_chunks(chunks, max_size):
+    """Yields `chunks` until `max_size` bytes have been yielded, then a note
+    saying the output was truncated"""
+    size = 0
+    chunks = iter(chunks)
+    for chunk in chunks:
+        if max_size is not None and size + len(chunk) > max_size:
+            yield chunk[:max_size - size]
+            yield '\n[diff truncated after %d bytes]\n' % max_size
+            if hasattr(chunks, 'close'):
+                chunks.close()
+            return
+        size += len(chunk)
+        yield chunk
+
+
+def scan_tree(root):
+    """Returns a dict mapping the path of every file and directory under
+    `root`, relative to `root`, to its stat result. Symlinks are followed,
+    like shutil.copytree does."""
+    tree = {}
+    stack = ['']
+    while stack:
+        rel_dir = stack.pop()
+        path = os.path.join(root, rel_dir)
+        if scandir is not None:
+            entries = [(e.name, e.stat) for e in scandir(path)]
         else:
-            print '\n'.join(diff)
+            entries = [(name, lambda name=name: os.stat(os.path.join(path, name)))
+                       for name in os.listdir(path)]
+        for name, stat in entries:
+            rel = os.path.join(rel_dir, name)
+            try:
+                st = stat()
+            except OSError:
+                # Broken symlink
+                continue
+            tree[rel] = st
+            if stat_module.S_ISDIR(st.st_mode):
+                stack.append(rel)
+    return tree
+
+
+def is_pattern(path):
+    return any(c in path for c in '*?[')
+
+
+def split_pattern(path):
+    """Splits a glob pattern into the directory that contains everything it
+    can match and the pattern relative to that directory"""
+    parts = path.split('/')
+    for i, part in enumerate(parts):
+        if is_pattern(part):
+            return '/'.join(parts[:i]) or '/', '/'.join(parts[i:])
+    return os.path.dirname(path), os.path.basename(path)
+
+
+def pattern_base(path):
+    """Returns the directory a `config_files` value is found in or below"""
+    return split_pattern(path)[0] if is_pattern(path) else path
+
+
+def compile_pattern(pattern):
+    """Compiles a relative glob pattern into a regex. `*`, `?` and `[...]` don't
+    match `/`, and a `**` component matches any number of directories."""
+    regex = ''
+    for i, part in enumerate(pattern.split('/')):
+        if part == '**':
+            regex += '(?:[^/]+/)*'
+            continue
+        j = 0
+        while j < len(part):
+            c = part[j]
+            if c == '*':
+                regex += '[^/]*'
+            elif c == '?':
+                regex += '[^/]'
+            elif c == '[' and ']' in part[j + 2:]:
+                end = part.index(']', j + 2)
+                chars = part[j + 1:end]
+                if chars.startswith('!'):
+                    chars = '^' + chars[1:]
+                regex += '[' + chars.replace('\\', '\\\\') + ']'
+                j = end
+            else:
+                regex += re.escape(c)
+            j += 1
+        regex += '/'
+    return re.compile(regex[:-1] + r'\Z')
+
+
+def is_ignored(rel_path, ignore):
+    """Returns whether `rel_path` or its file name matches one of the
+    `ignore` glob patterns"""
+    name = os.path.basename(rel_path)
+    return any(fnmatch.fnmatch(name, p) or fnmatch.fnmatch(rel_path, p)
+               for p in ignore)
+
+
+def walk_tree(root, max_depth=None, ignore=()):
+    """Lists the files under `root`, up to `max_depth` directories deep,
+    skipping ignored files and directories. Returns the paths relative to
+    `root` and a dict mapping every directory walked to its mtime."""
+    files = []
+    dir_mtimes = {}
+    stack = [('', 0)]
+    while stack:
+        rel_dir, depth = stack.pop()
+        path = os.path.join(root, rel_dir)
+        try:
+            dir_mtimes[rel_dir] = os.stat(path).st_mtime
+            if scandir is not None:
+                entries = [(e.name, e.is_dir()) for e in scandir(path)]
+            else:
+                entries = [(name, os.path.isdir(os.path.join(path, name)))
+                           for name in os.listdir(path)]
+        except OSError:
+            continue
+        for name, is_dir in entries:
+            rel = os.path.join(rel_dir, name)
+            if is_ignored(rel, ignore):
+                continue
+            if not is_dir:
+                files.append(rel)
+            elif max_depth is None or depth + 1 < max_depth:
+                stack.append((rel, depth + 1))
+    return files, dir_mtimes
+
+
+class PatternExpander:
+    """Expands the glob patterns in `config_files`. A pattern's key names a
+    directory in the configs dir, and every file matching the pattern, on the
+    system or in that directory, becomes an entry under it.
+
+    Each side is walked once per pattern, and the walk is cached on disk until
+    the mtime of one of the directories it walked changes."""
+    CACHE_VERSION = 1
+
+    def __init__(self, ignore=(), cache_path=None):
+        self.ignore = tuple(ignore)
+        self.cache_path = cache_path
+        self.cache = None
+        self.cache_changed = False
+
+    def walk(self, base, pattern):
+        if self.cache is None:
+            self.cache = (self.cache_path is not None
+                          and load_cache(self.cache_path, self.CACHE_VERSION)
+                          or {})
+        key = (base, pattern, self.ignore)
+        if key in self.cache:
+            dir_mtimes, files = self.cache[key]
+            try:
+                if all(os.stat(os.path.join(base, d)).st_mtime == mtime
+                       for d, mtime in dir_mtimes.iteritems()):
+                    return files
+            except OSError:
+                pass
+
+        max_depth = (None if '**' in pattern.split('/')
+                     else pattern.count('/') + 1)
+        files, dir_mtimes = walk_tree(base, max_depth, self.ignore)
+        regex = compile_pattern(pattern)
+        files = sorted(f for f in files if regex.match(f))
+        self.cache[key] = (dir_mtimes, files)
+        self.cache_changed = True
+        return files
+
+    def walked_dirs(self, base, pattern):
+        """Returns every directory the walk of `pattern` under `base` looked
+        in, which are the ones whose changes can change its matches"""
+        self.walk(base, pattern)
+        dir_mtimes, _ = self.cache[(base, pattern, self.ignore)]
+        return sorted(os.path.normpath(os.path.join(base, d))
+                      for d in dir_mtimes)
+
+    def expand(self, config_path, config_files):
+        """Returns `config_files` with `~` expanded and the patterns replaced
+        by the entries they match"""
+        expanded = {}
+        for f, system_config_path in config_files.iteritems():
+            system_config_path = os.path.expanduser(system_config_path)
+            if not is_pattern(system_config_path):
+                expanded[f] = system_config_path
+                continue
+            base, pattern = split_pattern(system_config_path)
+            matches = set(self.walk(base, pattern))
+            matches.update(self.walk(os.path.join(config_path, f), pattern))
+            for rel in matches:
+                expanded[os.path.join(f, rel)] = os.path.join(base, rel)
+
+        if self.cache_changed and self.cache_path is not None:
+            save_cache(self.cache_path, self.CACHE_VERSION, self.cache)
+            self.cache_changed = False
+        return expanded
+
+
+# From linux/fs.h
+FICLONE = 0x40049409
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+except OSError:
+    _libc = None
+
+try:
+    _copy_file_range = _libc.copy_file_range
+    _copy_file_range.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int,
+                                 ctypes.c_void_p, ctypes.c_size_t,
+                                 ctypes.c_uint]
+    _copy_file_range.restype = ctypes.c_ssize_t
+except (OSError, AttributeError):
+    _copy_file_range = None
+
+
+def copy_fd(fd_src, fd_dst):
+    """Copies everything after the current offset of `fd_src` to `fd_dst`,
+    using a reflink or copy_file_range where the filesystem supports them"""
+    try:
+        fcntl.ioctl(fd_dst, FICLONE, fd_src)
+        return
+    except IOError:
+        pass
+
+    if _copy_file_range is not None:
+        while True:
+            n = _copy_file_range(fd_src, None, fd_dst, None, 1 << 30, 0)
+            if n == 0:
+                return
+            if n < 0:
+                # Unsupported by the kernel or across these filesystems, so
+                # finish with read/write from wherever it stopped
+                if ctypes.get_errno() not in (errno.ENOSYS, errno.EXDEV,
+                                              errno.EINVAL, errno.EOPNOTSUPP):
+                    raise OSError(ctypes.get_errno(),
+                                  os.strerror(ctypes.get_errno()))
+                break
+
+    for chunk in iter(lambda: os.read(fd_src, 1 << 16), ''):
+        while chunk:
+            chunk = chunk[os.write(fd_dst, chunk):]
+
+
+def copy_file_data(src, dst):
+    """Copies the contents of `src` to `dst` like shutil.copyfile"""
+    fd_src = os.open(src, os.O_RDONLY)
+    try:
+        fd_dst = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0666)
+        try:
+            copy_fd(fd_src, fd_dst)
+        finally:
+            os.close(fd_dst)
+    finally:
+        os.close(fd_src)
+
+
+def get_manifest_path(configs_dir):
+    """Returns the path of the manifest stored next to `configs_dir`"""
+    configs_dir = os.path.normpath(configs_dir)
+    return os.path.join(os.path.dirname(configs_dir),
+                        '.%s.manifest' % os.path.basename(configs_dir))
+
+
+def get_journal_path(configs_dir):
+    """Returns the path of the install journal stored next to `configs_dir`"""
+    configs_dir = os.path.normpath(configs_dir)
+    return os.path.join(os.path.dirname(configs_dir),
+                        '.%s.journal' % os.path.basename(configs_dir))
+
+
+def fsync_path(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def sync_files(paths):
+    """Flushes `paths` to disk, followed by each directory containing them so
+    their new directory entries are on disk too"""
+    for path in paths:
+        fsync_path(path)
+    for directory in set(os.path.dirname(os.path.abspath(path))
+                         for path in paths):
+        fsync_path(directory)
+
+
+class ConfigTransaction:
+    """Installs a group of files atomically. Each file is first written to a
+    temporary file next to its destination, and the temporary files are only
+    renamed into place once all of them are on disk.
+
+    The journal lists the temporary files as they're written, followed by a
+    `commit` line once they're all on disk. An interrupted install is rolled
+    back (the temporary files are removed) if the journal has no `commit`
+    line, or rolled forward (the remaining renames are done) if it does."""
+    COMMIT = 'commit'
+
+    def __init__(self, journal_path):
+        self.journal_path = journal_path
+        self.journal = open(journal_path, 'w')
+        self.entries = []
+
+    def stage(self, src, dst):
+        """Copies `src` to a temporary file that will replace `dst` and returns
+        the temporary file's path"""
+        # Replace the file a symlink points to rather than the symlink itself
+        dst = os.path.realpath(dst)
+        tmp = os.path.join(os.path.dirname(dst),
+                           '.%s.archutil-tmp' % os.path.basename(dst))
+        self.journal.write(json.dumps([tmp, dst]) + '\n')
+        self.journal.flush()
+        copy_file_data(src, tmp)
+        if os.path.exists(dst):
+            # Keep the mode and owner dst would have kept if it had been
+            # overwritten in place
+            st = os.stat(dst)
+            os.chmod(tmp, stat_module.S_IMODE(st.st_mode))
+            try:
+                os.chown(tmp, st.st_uid, st.st_gid)
+            except OSError:
+                pass
+        self.entries.append((tmp, dst))
+        return tmp
+
+    def commit(self):
+        sync_files([tmp for tmp, _ in self.entries])
+        self.journal.write(self.COMMIT + '\n')
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+        fsync_path(os.path.dirname(os.path.abspath(self.journal_path)))
+        self.journal.close()
+        self.roll_forward(self.journal_path, self.entries)
+
+    def roll_back(self):
+        self.journal.close()
+        self.roll_back_entries(self.journal_path, self.entries)
+
+    @staticmethod
+    def roll_forward(journal_path, entries):
+        for tmp, dst in entries:
+            # Entries renamed before an interruption are already in place
+            if os.path.exists(tmp):
+                os.rename(tmp, dst)
+        for directory in set(os.path.dirname(dst) for _, dst in entries):
+            fsync_path(directory)
+        os.remove(journal_path)
+
+    @staticmethod
+    def roll_back_entries(journal_path, entries):
+        for tmp, _ in entries:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        os.remove(journal_path)
+
+    @classmethod
+    def recover(cls, journal_path):
+        """Finishes or undoes the install interrupted while writing
+        `journal_path`. Returns 'forward' or 'back' for what was done, or None
+        if there was nothing to recover."""
+        try:
+            with open(journal_path) as f:
+                lines = f.read().split('\n')
+        except IOError:
+            return None
+        # The last line is empty, or was being written when interrupted
+        lines = lines[:-1]
+        committed = lines[-1:] == [cls.COMMIT]
+        entries = [json.loads(line) for line in lines if line != cls.COMMIT]
+        if committed:
+            cls.roll_forward(journal_path, entries)
+            return 'forward'
+        cls.roll_back_entries(journal_path, entries)
+        return 'back'
+
+
+def get_backup_store_path(configs_dir):
+    return os.path.join(configs_dir, '.archutil')
+
+
+class BackupStore:
+    """Content-addressed store for the files config installs overwrite. File
+    contents are stored once under `objects/`, named by their hash, and each
+    install records a snapshot in `snapshots/` mapping the backed up paths to
+    their hashes and modes."""
+
+    def __init__(self, path):
+        self.path = path
+        self.objects_dir = os.path.join(path, 'objects')
+        self.snapshots_dir = os.path.join(path, 'snapshots')
+        self.files = {}
+
+    def object_path(self, digest):
+        return os.path.join(self.objects_dir, digest[:2], digest[2:])
+
+    def store_object(self, path):
+        """Adds the contents of `path` to the store and returns their hash"""
+        digest = hash_file(path)
+        object_path = self.object_path(digest)
+        if not os.path.exists(object_path):
+            if not os.path.isdir(os.path.dirname(object_path)):
+                os.makedirs(os.path.dirname(object_path))
+            tmp = object_path + '.tmp'
+            copy_file_data(path, tmp)
+            os.rename(tmp, object_path)
+        return digest
+
+    def backup(self, path):
+        """Adds the file at `path`, or every file under it if it's a
+        directory, to the next snapshot. Symlinks are recorded as the file
+        they point to, so restoring them keeps the link."""
+        path = os.path.realpath(path)
+        if os.path.isdir(path):
+            paths = [os.path.join(path, rel)
+                     for rel, st in sorted(scan_tree(path).iteritems())
+                     if stat_module.S_ISREG(st.st_mode)]
+        else:
+            paths = [path]
+        for p in paths:
+            self.files[p] = {'hash': self.store_object(p),
+                             'mode': stat_module.S_IMODE(os.stat(p).st_mode)}
+
+    def save_snapshot(self):
+        """Writes the snapshot of the files backed up since the last one and
+        returns its id, or None if nothing was backed up"""
+        if not self.files:
+            return None
+        if not os.path.isdir(self.snapshots_dir):
+            os.makedirs(self.snapshots_dir)
+        now = time.time()
+        base = time.strftime('%Y%m%d-%H%M%S', time.localtime(now))
+        snapshot_id = base
+        i = 1
+        while os.path.exists(self.snapshot_path(snapshot_id)):
+            snapshot_id = '%s-%d' % (base, i)
+            i += 1
+        tmp = self.snapshot_path(snapshot_id) + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'time': now, 'files': self.files}, f, indent=1,
+                      sort_keys=True)
+        os.rename(tmp, self.snapshot_path(snapshot_id))
+        self.files = {}
+        return snapshot_id
+
+    def snapshot_path(self, snapshot_id):
+        return os.path.join(self.snapshots_dir, snapshot_id + '.json')
+
+    def snapshot_ids(self):
+        """Returns the ids of the stored snapshots, oldest first"""
+        if not os.path.isdir(self.snapshots_dir):
+            return []
+        return sorted((name[:-len('.json')]
+                       for name in os.listdir(self.snapshots_dir)
+                       if name.endswith('.json')),
+                      key=lambda i: (self.load_snapshot(i)['time'], i))
+
+    def load_snapshot(self, snapshot_id):
+        with open(self.snapshot_path(snapshot_id)) as f:
+            return json.load(f)
+
+    def restore(self, snapshot_id, paths=None):
+        """Restores the files in a snapshot, or only those in or under
+        `paths`, and returns the restored paths. The files being replaced are
+        backed up in a new snapshot first."""
+        snapshot = self.load_snapshot(snapshot_id)
+        if paths is not None:
+            paths = set(f(p).rstrip('/') for p in paths
+                        for f in (os.path.abspath, os.path.realpath))
+        restored = sorted(
+            str(p) for p in snapshot['files']
+            if paths is None or any(p == q or p.startswith(q + '/')
+                                    for q in paths))
+        for path in restored:
+            if os.path.isfile(path):
+                self.backup(path)
+        self.save_snapshot()
+
+        for path in restored:
+            entry = snapshot['files'][path]
+            # Replace the file a symlink points to rather than the symlink
+            target = os.path.realpath(path)
+            if not os.path.isdir(os.path.dirname(target)):
+                os.makedirs(os.path.dirname(target))
+            tmp = os.path.join(os.path.dirname(target),
+                               '.%s.archutil-tmp' % os.path.basename(target))
+            copy_file_data(self.object_path(entry['hash']), tmp)
+            os.chmod(tmp, entry['mode'])
+            os.rename(tmp, target)
+        return restored
+
+    def gc(self, keep=None, max_age=None):
+        """Deletes the snapshots that are neither among the `keep` newest nor
+        younger than `max_age` seconds, then the objects no remaining snapshot
+        refers to. Returns the number of snapshots and objects deleted."""
+        snapshot_ids = self.snapshot_ids()
+        now = time.time()
+        removed_snapshots = 0
+        referenced = set()
+        for i, snapshot_id in enumerate(reversed(snapshot_ids)):
+            snapshot = self.load_snapshot(snapshot_id)
+            if ((keep is None and max_age is None)
+                    or (keep is not None and i < keep)
+                    or (max_age is not None
+                        and now - snapshot['time'] < max_age)):
+                referenced.update(e['hash']
+                                  for e in snapshot['files'].itervalues())
+            else:
+                os.remove(self.snapshot_path(snapshot_id))
+                removed_snapshots += 1
+
+        removed_objects = 0
+        if os.path.isdir(self.objects_dir):
+            for prefix in os.listdir(self.objects_dir):
+                for name in os.listdir(os.path.join(self.objects_dir, prefix)):
+                    if prefix + name not in referenced:
+                        os.remove(os.path.join(self.objects_dir, prefix, name))
+                        removed_objects += 1
+        return removed_snapshots, removed_objects
+
+
+class ConfigManifest:
+    """Records the stat signature and content hash of both sides of every
+    compared config file, along with the comparison result. Files whose
+    signatures haven't changed since the last run are classified from the
+    manifest without being read."""
+    VERSION = 1
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = load_cache(path, self.VERSION) or {}
+        self.changed = False
+        self.lock = threading.Lock()
+
+    def get(self, backup_config_path, system_config_path):
+        """Returns the (backup_signature, backup_hash, system_signature,
+        system_hash, result) entry for a pair of files, or None"""
+        return self.entries.get((backup_config_path, system_config_path))
+
+    def set(self, backup_config_path, system_config_path, entry):
+        key = (backup_config_path, system_config_path)
+        with self.lock:
+            if self.entries.get(key) != entry:
+                self.entries[key] = entry
+                self.changed = True
+
+    def save(self):
+        with self.lock:
+            if self.changed:
+                save_cache(self.path, self.VERSION, self.entries)
+                self.changed = False
 
 
 class ConfigHandler:
-    def __init__(self, configs_dir):
+    def __init__(self, configs_dir, manifest=None, jobs=4,
+                 max_diff_size=DEFAULT_MAX_DIFF_SIZE, expander=None,
+                 journal_path=None, backup_store=None, policy_rules=()):
         self.configs_dir = configs_dir
+        self.manifest = manifest
+        self.jobs = jobs
+        self.max_diff_size = max_diff_size
+        if expander is None:
+            expander = PatternExpander()
+        self.expander = expander
+        if journal_path is None:
+            journal_path = get_journal_path(configs_dir)
+        self.journal_path = journal_path
+        self.transaction = None
+        # Without a BackupStore, overwritten files are backed up as .bak files
+        self.backup_store = backup_store
+        # (pattern, 'system' or 'backup') pairs deciding which side of a
+        # differing file a plan keeps
+        self.policy_rules = policy_rules
+
+    class DiffResult(object):
+        """The result of comparing a backup config file with its system config
+        file. The `diff` output isn't stored, it's generated when displayed."""
+        __slots__ = ('backup_config_exists', 'system_config_exists', 'result',
+                     'backup_config_path', 'system_config_path', '_diff_output')
 
-    class DiffResult:
         MATCHES = 'Matches'
         DIFFERS = 'Differs'
         DOESNT_EXIST = "Doesn't exist"
 
         def __init__(self, backup_config_exists, system_config_exists, result,
-                     backup_config_path, system_config_path, diff_output):
+                     backup_config_path, system_config_path, diff_output=None):
             self.backup_config_exists = backup_config_exists
             self.system_config_exists = system_config_exists
             self.result = result
             self.backup_config_path = backup_config_path
             self.system_config_path = system_config_path
-            self.diff_output = diff_output
+            self._diff_output = diff_output
+
+        def iter_diff(self, max_size=None):
+            """Yields the `diff` output in chunks, stopping after `max_size`
+            bytes if it's set"""
+            if self._diff_output is not None:
+                chunks = [self._diff_output]
+            elif self.result == self.DIFFERS:
+                chunks = iter_diff_output(self.backup_config_path,
+                                          self.system_config_path)
+            else:
+                chunks = []
+            return truncate_chunks(chunks, max_size)
+
+        @property
+        def diff_output(self):
+            return ''.join(self.iter_diff())
+
+        def as_dict(self):
+            d = dict((k, getattr(self, k)) for k in self.__slots__[:-1])
+            d['diff_output'] = self.diff_output
+            return d
 
         def __str__(self):
-            return str(self.__dict__)
+            return str(self.as_dict())
 
         def __eq__(self, other):
             if isinstance(other, self.__class__):
-                return self.__dict__ == other.__dict__
+                return self.as_dict() == other.as_dict()
             else:
                 return False
 
+        def __ne__(self, other):
+            return not self == other
+
+    def compare_files(self, backup_config_path, system_config_path):
+        """Compares two regular files by size and then by content hash,
+        reusing the manifest entry for the pair when neither file changed"""
+        backup_sig = stat_signature(backup_config_path)
+        system_sig = stat_signature(system_config_path)
+
+        old = None
+        if self.manifest is not None:
+            old = self.manifest.get(backup_config_path, system_config_path)
+        if old is not None and old[0] == backup_sig and old[2] == system_sig:
+            return old[4]
+
+        # Only rehash the sides that changed since the manifest entry
+        backup_hash = system_hash = None
+        if old is not None:
+            backup_hash = old[1] if old[0] == backup_sig else None
+            system_hash = old[3] if old[2] == system_sig else None
+
+        if backup_sig[0] != system_sig[0]:
+            result = self.DiffResult.DIFFERS
+        else:
+            if backup_hash is None:
+                backup_hash = hash_file(backup_config_path)
+            if system_hash is None:
+                system_hash = hash_file(system_config_path)
+            result = (self.DiffResult.MATCHES if backup_hash == system_hash
+                      else self.DiffResult.DIFFERS)
+
+        if self.manifest is not None:
+            self.manifest.set(backup_config_path, system_config_path,
+                              (backup_sig, backup_hash, system_sig,
+                               system_hash, result))
+        return result
+
+    def run_diff(self, backup_config_path, system_config_path):
+        """Returns whether `diff` finds no differences, without keeping its
+        output"""
+        dev_null = open(os.devnull, 'w')
+        return tracer.call(subprocess.call,
+                           ['diff', '-q', backup_config_path,
+                            system_config_path], stdout=dev_null) == 0
+
+    def diff_entry(self, backup_config_path, system_config_path):
+        backup_config_exists = os.path.exists(backup_config_path)
+        system_config_exists = os.path.exists(system_config_path)
+        if not backup_config_exists or not system_config_exists:
+            return self.DiffResult(
+                backup_config_exists, system_config_exists,
+                self.DiffResult.DOESNT_EXIST, backup_config_path,
+                system_config_path)
+
+        if (os.path.isfile(backup_config_path)
+                and os.path.isfile(system_config_path)):
+            diff_result = self.compare_files(backup_config_path,
+                                             system_config_path)
+        else:
+            diff_result = (self.DiffResult.MATCHES
+                           if self.run_diff(backup_config_path,
+                                            system_config_path)
+                           else self.DiffResult.DIFFERS)
+
+        return self.DiffResult(
+            backup_config_exists, system_config_exists, diff_result,
+            backup_config_path, system_config_path)
+
     def config_diff(self, config_path, config_files):
-        results = []
-        for f, system_config_path in config_files.iteritems():
-            backup_config_path = os.path.join(config_path, f)
-            backup_config_exists = os.path.exists(backup_config_path)
-            system_config_exists = os.path.exists(system_config_path)
-            if not backup_config_exists or not system_config_exists:
-                result = self.DiffResult(
-                    backup_config_exists, system_config_exists,
-                    self.DiffResult.DOESNT_EXIST, backup_config_path,
-                    system_config_path, '')
-                results.append(result)
-            else:
-                p = subprocess.Popen(
-                    ['diff', backup_config_path, system_config_path],
-                    stdout=subprocess.PIPE)
-                diff_output, _ = p.communicate()
-                diff_result = (self.DiffResult.MATCHES
-                               if p.returncode == 0
-                               else self.DiffResult.DIFFERS)
-                result = self.DiffResult(
-                    backup_config_exists, system_config_exists, diff_result,
-                    backup_config_path, system_config_path, diff_output)
-                results.append(result)
-
-        assert len(results) == len(config_files)
-        return results
+        """Compares every backup config file with its system config file,
+        yielding a DiffResult for each entry in `config_files` sorted by name.
+        Entries are compared by `self.jobs` threads and each result is yielded
+        as soon as it and all results before it are ready.
+
+        Regular files are compared in-process and `diff` is only run on
+        directories. Glob patterns are expanded first, see PatternExpander."""
+        def diff(item):
+            f, system_config_path = item
+            return self.diff_entry(os.path.join(config_path, f),
+                                   system_config_path)
+
+        with tracer.phase('expand config files'):
+            config_files = self.expander.expand(config_path, config_files)
+        try:
+            for result in parallel_imap(diff, sorted(config_files.iteritems()),
+                                        self.jobs):
+                yield result
+        finally:
+            if self.manifest is not None:
+                self.manifest.save()
 
     def install_config_files(self, results):
+        self.install_results(results)
+        self.save_backup_snapshot()
+
+    def save_backup_snapshot(self):
+        if self.backup_store is not None:
+            snapshot_id = self.backup_store.save_snapshot()
+            if snapshot_id is not None:
+                print_msg('Backed up the replaced files as snapshot '
+                          + snapshot_id, colors.BLUE)
+
+    def install_results(self, results):
         for r in results:
             if not r.backup_config_exists:
                 print_msg(r.backup_config_path + " does not exist", colors.RED)
@@ -162,6 +2053,41 @@ class ConfigHandler:
                     os.makedirs(dirname)
                 self.safe_copy(r.backup_config_path, r.system_config_path)
 
+    def atomic_install_config_files(self, results):
+        """Installs like `install_config_files`, but renames every file into
+        place only once all of them have been written, see ConfigTransaction"""
+        self.transaction = ConfigTransaction(self.journal_path)
+        try:
+            self.install_results(results)
+        except BaseException:
+            self.transaction.roll_back()
+            # Nothing was replaced, so there's nothing to record
+            if self.backup_store is not None:
+                self.backup_store.files = {}
+            raise
+        else:
+            self.transaction.commit()
+        finally:
+            self.transaction = None
+        self.save_backup_snapshot()
+
+    def recover_install(self):
+        """Recovers from an interrupted atomic install, if there was one"""
+        recovered = ConfigTransaction.recover(self.journal_path)
+        if recovered == 'forward':
+            print_msg('Finished installing the files of an interrupted install',
+                      colors.YELLOW)
+        elif recovered == 'back':
+            print_msg('Rolled back an interrupted install', colors.YELLOW)
+
+    def copy_file(self, src, dst):
+        """Copies the contents of `src` to `dst`, or stages them to replace
+        `dst` during an atomic install. Returns the path written to."""
+        if self.transaction is not None:
+            return self.transaction.stage(src, dst)
+        copy_file_data(src, dst)
+        return dst
+
     def update_config_files(self, results):
         for r in results:
             if not r.system_config_exists:
@@ -178,7 +2104,7 @@ class ConfigHandler:
                 print_msg((r.system_config_path +
                            ' differs from ' + r.backup_config_path),
                           colors.YELLOW)
-                print r.diff_output
+                self.print_diff(r)
 
                 prompt = ('Update config file with system config '
                           'file (< is config file, > is system '
@@ -190,7 +2116,8 @@ class ConfigHandler:
 
     def safe_copy(self, path1, path2, safe=True):
         """Safely copies path1 to path2, backing up any file originally at path2
-        as path2.bak"""
+        to the backup store, or as path2.bak without one. Directories are
+        synced incrementally, see `sync_tree`."""
 
         def check_all(func, args):
             return all(map(func, args))
@@ -201,14 +2128,59 @@ class ConfigHandler:
                 print_msg(('Both paths must either be only files or only'
                            'directories'), colors.RED)
                 return
-            self.safe_copy(path2, os.path.normpath(path2) + ".bak")
+            if os.path.isfile(path2) and self.backup_store is not None:
+                self.backup_store.backup(path2)
+            elif os.path.isfile(path2):
+                self.safe_copy(path2, os.path.normpath(path2) + ".bak")
 
-        print_msg("Copying %s to %s" % (path1, path2), colors.GREEN)
         if os.path.isdir(path1):
-            shutil.copytree(path1, path2)
+            print_msg("Syncing %s to %s" % (path1, path2), colors.GREEN)
+            self.sync_tree(path1, path2, safe)
         else:
             assert os.path.isfile(path1)
-            shutil.copyfile(path1, path2)
+            print_msg("Copying %s to %s" % (path1, path2), colors.GREEN)
+            self.copy_file(path1, path2)
+
+    def sync_tree(self, src, dst, safe=True):
+        """Copies the files under `src` that are missing from `dst` or differ
+        from it, like rsync does. When `safe` is set, each file about
+        to be overwritten is backed up to the backup store, or to the same
+        relative path under dst.bak without one. Files only in `dst` are left
+        alone."""
+        src_tree = scan_tree(src)
+        dst_tree = scan_tree(dst) if os.path.isdir(dst) else {}
+        backup_dir = os.path.normpath(dst) + '.bak'
+
+        if not os.path.isdir(dst):
+            os.makedirs(dst)
+        for rel in sorted(src_tree):
+            st = src_tree[rel]
+            old = dst_tree.get(rel)
+            target = os.path.join(dst, rel)
+            if stat_module.S_ISDIR(st.st_mode):
+                if old is None:
+                    os.mkdir(target)
+                continue
+
+            # An edit within the same mtime tick keeps size and mtime, so
+            # those are only trusted once the contents match too
+            if (old is not None and old.st_size == st.st_size
+                    and old.st_mtime == st.st_mtime
+                    and hash_file(os.path.join(src, rel))
+                    == hash_file(target)):
+                continue
+
+            if old is not None and safe and self.backup_store is not None:
+                self.backup_store.backup(target)
+            elif old is not None and safe:
+                backup = os.path.join(backup_dir, rel)
+                if not os.path.isdir(os.path.dirname(backup)):
+                    os.makedirs(os.path.dirname(backup))
+                self.safe_copy(target, backup)
+            written = self.copy_file(os.path.join(src, rel), target)
+            shutil.copymode(os.path.join(src, rel), written)
+            # Keep the mtime so the next sync can skip this file
+            os.utime(written, (st.st_atime, st.st_mtime))
 
     def yes_no_choice(self, prompt, default_yes):
         yes = set(['yes', 'y', 'ye'])
@@ -220,7 +2192,13 @@ class ConfigHandler:
             no.add('')
 
         while True:
-            choice = raw_input(prompt).lower()
+            if output.format == 'text':
+                choice = raw_input(prompt).lower()
+            else:
+                # Keep the prompt out of the JSON written to stdout
+                sys.stderr.write(prompt)
+                sys.stderr.flush()
+                choice = sys.stdin.readline().strip().lower()
             if choice in yes:
                 return True
             elif choice in no:
@@ -228,91 +2206,523 @@ class ConfigHandler:
             else:
                 printc("Please respond with 'y' or 'n'", colors.YELLOW)
 
+    def print_diff(self, r):
+        if output.format != 'text':
+            output.record('diff', None,
+                          backup_config_path=r.backup_config_path,
+                          system_config_path=r.system_config_path,
+                          diff=''.join(r.iter_diff(self.max_diff_size)))
+            return
+        for chunk in r.iter_diff(self.max_diff_size):
+            sys.stdout.write(chunk)
+        print
+
+    def describe_result(self, r):
+        """Returns the message and color describing a DiffResult"""
+        if r.result == self.DiffResult.DOESNT_EXIST:
+            if not r.system_config_exists:
+                return r.system_config_path + ' does not exist', colors.YELLOW
+            else:
+                assert not r.backup_config_exists
+                return r.backup_config_path + ' does not exist', colors.YELLOW
+        elif r.result == self.DiffResult.MATCHES:
+            return (r.system_config_path + ' matches ' + r.backup_config_path,
+                    colors.BLUE)
+        else:
+            assert r.result == self.DiffResult.DIFFERS
+            return (r.system_config_path + ' differs from '
+                    + r.backup_config_path, colors.YELLOW)
+
     def print_diff_results(self, results, output_diff):
         for r in results:
-            if r.result == self.DiffResult.DOESNT_EXIST:
-                if not r.system_config_exists:
-                    print_msg(r.system_config_path + ' does not exist',
-                              colors.YELLOW)
-                else:
-                    assert not r.backup_config_exists
-                    print_msg(r.backup_config_path + ' does not exist',
-                              colors.YELLOW)
-            elif r.result == self.DiffResult.MATCHES:
-                print_msg((r.system_config_path +
-                           ' matches ' + r.backup_config_path), colors.BLUE)
+            output_diff_now = r.result == self.DiffResult.DIFFERS and output_diff
+            message, color = self.describe_result(r)
+            if output.format == 'text':
+                print_msg(message, color)
+                if output_diff_now:
+                    self.print_diff(r)
+                continue
+
+            fields = dict((k, getattr(r, k))
+                          for k in self.DiffResult.__slots__[:-1])
+            if output_diff_now:
+                fields['diff'] = ''.join(r.iter_diff(self.max_diff_size))
+            output.record('config', None, message=message, **fields)
+
+    PLAN_VERSION = 1
+
+    def resolve_conflict(self, name, system_config_path):
+        """Returns the plan action the first policy rule matching the entry
+        name or system path gives a differing file, or 'conflict'"""
+        for pattern, side in self.policy_rules:
+            if (fnmatch.fnmatch(name, pattern)
+                    or fnmatch.fnmatch(system_config_path, pattern)):
+                return 'update' if side == 'system' else 'install'
+        return 'conflict'
+
+    def make_plan(self, results):
+        """Returns a plan entry for each DiffResult. `update` copies the system
+        file to the backup, `install` the backup to the system, and `skip` and
+        `conflict` leave both alone. The hashes let `apply_plan` check that
+        neither file changed since."""
+        plan = []
+        for r in results:
+            name = os.path.relpath(r.backup_config_path, self.configs_dir)
+            if r.result == self.DiffResult.MATCHES:
+                action = 'skip'
+            elif r.result == self.DiffResult.DIFFERS:
+                action = self.resolve_conflict(name, r.system_config_path)
+            elif r.system_config_exists:
+                action = 'update'
+            elif r.backup_config_exists:
+                action = 'install'
             else:
-                assert r.result == self.DiffResult.DIFFERS
-                print_msg((r.system_config_path +
-                           ' differs from ' + r.backup_config_path),
-                          colors.YELLOW)
-                if output_diff:
-                    print r.diff_output
+                action = 'skip'
+            plan.append({'name': name, 'action': action,
+                         'backup_config_path': r.backup_config_path,
+                         'system_config_path': r.system_config_path,
+                         'backup_hash': hash_path(r.backup_config_path),
+                         'system_hash': hash_path(r.system_config_path)})
+        return plan
+
+    def write_plan(self, path, results):
+        plan = []
+        counts = {}
+        for entry in self.make_plan(results):
+            plan.append(entry)
+            counts[entry['action']] = counts.get(entry['action'], 0) + 1
+            output.record('plan', '%-8s %s' % (entry['action'], entry['name']),
+                          **entry)
+        with open(path, 'w') as f:
+            json.dump({'version': self.PLAN_VERSION, 'entries': plan}, f,
+                      indent=1, sort_keys=True)
+        print_msg('Wrote plan to %s: %s' % (path, ', '.join(
+            '%d %s' % (n, action) for action, n in sorted(counts.items()))),
+                  colors.BLUE)
+
+    def apply_plan(self, path):
+        """Runs the actions in the plan at `path`. Conflicts are resolved by the
+        policy rules if they can be, and entries whose files changed since the
+        plan was made are skipped."""
+        with open(path) as f:
+            plan = json.load(f)
+        if plan.get('version') != self.PLAN_VERSION:
+            raise ValueError('%s is not a config plan' % path)
+
+        try:
+            for entry in plan['entries']:
+                entry = to_str(entry)
+                action = entry['action']
+                backup_path = entry['backup_config_path']
+                system_path = entry['system_config_path']
+                if action == 'conflict':
+                    action = self.resolve_conflict(entry['name'], system_path)
+                if action == 'conflict':
+                    print_msg('Conflict, skipping ' + entry['name'],
+                              colors.RED)
+                    continue
+                if action == 'skip':
+                    continue
+
+                if (hash_path(backup_path) != entry['backup_hash']
+                        or hash_path(system_path) != entry['system_hash']):
+                    print_msg('%s changed since the plan was made, skipping'
+                              % entry['name'], colors.RED)
+                    continue
+                if action == 'install':
+                    dirname = os.path.dirname(system_path)
+                    if not os.path.isdir(dirname):
+                        os.makedirs(dirname)
+                    self.safe_copy(backup_path, system_path)
+                else:
+                    assert action == 'update'
+                    dirname = os.path.dirname(backup_path)
+                    if not os.path.isdir(dirname):
+                        os.makedirs(dirname)
+                    self.safe_copy(system_path, backup_path, False)
+        finally:
+            if self.backup_store is not None:
+                self.backup_store.save_snapshot()
 
     def handle(self, args):
-        results = self.config_diff(self.configs_dir, config.config_files)
+        self.recover_install()
+        if args.apply is not None:
+            with tracer.phase('config'):
+                self.apply_plan(args.apply)
+            return
+        with tracer.phase('config'):
+            self.handle_results(
+                args, self.config_diff(self.configs_dir, config.config_files))
+
+    def handle_results(self, args, results):
         if args.diff:
             self.print_diff_results(results, False)
         elif args.diff_file:
             self.print_diff_results(results, True)
+        elif args.install and args.atomic:
+            self.atomic_install_config_files(results)
         elif args.install:
             self.install_config_files(results)
         elif args.update:
             self.update_config_files(results)
+        elif args.plan is not None:
+            self.write_plan(args.plan, results)
         else:
             raise ValueError("Argument required for config subcommand")
 
 
-class InstallHandler:
-    def __init__(self, pacman):
-        self.pacman = pacman
+def parse_mtree(text):
+    """Yields (path, attributes) for the entries of an mtree file, with the
+    /set defaults applied and the leading ./ removed from paths"""
+    defaults = {}
+    for line in text.split('\n'):
+        if not line or line.startswith('#'):
+            continue
+        words = line.split()
+        attributes = dict(w.split('=', 1) for w in words[1:] if '=' in w)
+        if words[0] == '/set':
+            defaults.update(attributes)
+        elif words[0] == '/unset':
+            for key in words[1:]:
+                defaults.pop(key, None)
+        else:
+            entry = dict(defaults)
+            entry.update(attributes)
+            # Special characters are escaped as octal \NNN
+            path = re.sub(r'\\([0-7]{3})', lambda m: chr(int(m.group(1), 8)),
+                          words[0])
+            yield path[2:] if path.startswith('./') else path, entry
+
+
+def hash_file_sha256(path):
+    """Returns `path` and the sha256 of its contents, or None if it can't be
+    read. Runs in MtreeScanner worker processes."""
+    h = hashlib.sha256()
+    try:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 16), ''):
+                h.update(chunk)
+    except IOError:
+        return path, None
+    return path, h.hexdigest()
+
+
+class MtreeScanner:
+    """Finds the files under `prefixes` of a root that differ from what their
+    package shipped, according to the mtree files in the local database.
+
+    Like `pacman -Qkk`, files whose size and mtime match the mtree are taken
+    as unmodified. Only the rest are hashed, in a process pool, and their
+    hashes are cached by stat signature between runs."""
+    CACHE_VERSION = 1
+
+    def __init__(self, root='/', dbpath=None, prefixes=('etc/',),
+                 processes=None, cache_path=None):
+        self.root = root
+        self.dbpath = dbpath or get_dbpath(None if root == '/' else root)
+        # mtree paths are relative, so /etc has to match as etc
+        self.prefixes = tuple(p.lstrip('/') for p in prefixes)
+        self.processes = processes or multiprocessing.cpu_count()
+        if cache_path is None:
+            cache_path = get_cache_path('mtree-hashes', root)
+        self.cache_path = cache_path
+
+    def iter_entries(self):
+        """Yields (package, path, attributes) for the regular files under
+        `prefixes` in every package's mtree"""
+        local_dir = os.path.join(self.dbpath, 'local')
+        for entry in sorted(os.listdir(local_dir)):
+            mtree_path = os.path.join(local_dir, entry, 'mtree')
+            if not os.path.isfile(mtree_path):
+                continue
+            with open(os.path.join(local_dir, entry, 'desc')) as f:
+                package = parse_db_desc(f.read())['NAME'][0]
+            with gzip.open(mtree_path) as f:
+                text = f.read()
+            for path, attributes in parse_mtree(text):
+                if (attributes.get('type', 'file') == 'file'
+                        and path.startswith(self.prefixes)):
+                    yield package, path, attributes
+
+    def hash_files(self, paths):
+        """Returns a dict mapping each of `paths` to its sha256"""
+        if len(paths) < 2 * self.processes:
+            return dict(map(hash_file_sha256, paths))
+        pool = multiprocessing.Pool(self.processes)
+        try:
+            return dict(pool.imap_unordered(hash_file_sha256, paths,
+                                            chunksize=8))
+        finally:
+            pool.close()
+            pool.join()
+
+    def scan(self):
+        """Returns a sorted list of (path, package, reason) for the modified
+        files, where `reason` is 'size', 'sha256' or 'unreadable'"""
+        cache = load_cache(self.cache_path, self.CACHE_VERSION) or {}
+        new_cache = {}
+        modified = []
+        to_hash = {}
+        for package, path, attributes in self.iter_entries():
+            system_path = os.path.join(self.root, path)
+            try:
+                st = os.stat(system_path)
+            except OSError:
+                # Missing files aren't modified configs
+                continue
+            if 'size' in attributes and st.st_size != int(attributes['size']):
+                modified.append((system_path, package, 'size'))
+                continue
+            if ('time' in attributes and int(st.st_mtime)
+                    == int(float(attributes['time']))):
+                continue
+            if 'sha256digest' not in attributes:
+                continue
+            signature = (st.st_size, st.st_mtime, st.st_ino)
+            if path in cache and cache[path][0] == signature:
+                new_cache[path] = cache[path]
+                digest = cache[path][1]
+                if digest != attributes['sha256digest']:
+                    modified.append((system_path, package,
+                                     'sha256' if digest else 'unreadable'))
+                continue
+            to_hash[system_path] = (package, path, signature,
+                                    attributes['sha256digest'])
 
-    def check_packages_exist(self, packages, categories):
-        bad_packages = []
-        dev_null = open(os.devnull, 'w')
-        package_list = [p for c in categories for p in packages[c]]
+        with tracer.phase('hash files'):
+            digests = self.hash_files(sorted(to_hash))
+        for system_path, digest in digests.iteritems():
+            package, path, signature, expected = to_hash[system_path]
+            new_cache[path] = (signature, digest)
+            if digest != expected:
+                modified.append((system_path, package,
+                                 'sha256' if digest else 'unreadable'))
 
-        all_packages = subprocess.check_output([self.pacman, '-Ssq']).split('\n')
-        missing_packages = set(package_list) - set(all_packages)
+        if new_cache != cache:
+            save_cache(self.cache_path, self.CACHE_VERSION, new_cache)
+        return sorted(modified)
 
-        # Remove groups from missing_packages
-        all_groups = set(subprocess.check_output(['pacman', '-Sg']).split('\n'))
 
-        missing_packages -= all_groups
+class ScanHandler:
+    """Prints the package files that were modified as candidate
+    `config_files` entries"""
 
-        # Fallback to checking individual bad packages if pacman is not used.
-        # This is required in case packages are actually in the AUR
-        # TODO: Use this https://wiki.archlinux.org/index.php/AurJson
-        bad_packages = []
-        if os.path.basename(self.pacman) != 'pacman':
-            for p in missing_packages:
-                retcode = subprocess.call(self.pacman + ' -Ssq %s | grep "^%s$"'
-                                          % (p, p), shell=True, stdout=dev_null)
+    def __init__(self, roots):
+        self.roots = roots
+
+    def handle(self, args):
+        tracked = set(os.path.expanduser(p)
+                      for p in config.config_files.itervalues())
+        for root in self.roots:
+            scanner = MtreeScanner(root, prefixes=args.scan_prefix)
+            try:
+                with tracer.phase('scan ' + root):
+                    modified = scanner.scan()
+            except (IOError, OSError) as e:
+                print_msg('%s: %s' % (root, e), colors.RED)
+                continue
+            print_msg('Modified package files in %s not in config_files'
+                      % root, colors.BLUE)
+            for path, package, reason in modified:
+                rel = os.path.relpath(path, root)
+                if os.path.join('/', rel) in tracked or path in tracked:
+                    continue
+                output.record('scan', "    %r: %r,  # %s (%s)"
+                              % (rel, os.path.join('/', rel), package, reason),
+                              root=root, path=path, package=package,
+                              reason=reason)
+
+
+class BackupHandler:
+    """Lists, restores and garbage collects the snapshots in a BackupStore"""
+
+    def __init__(self, store):
+        self.store = store
+
+    def handle(self, args):
+        if args.backups_command == 'list':
+            for snapshot_id in self.store.snapshot_ids():
+                snapshot = self.store.load_snapshot(snapshot_id)
+                if output.format != 'text':
+                    output.record('snapshot', None, id=snapshot_id,
+                                  time=snapshot['time'],
+                                  files=sorted(snapshot['files']))
+                    continue
+                print_msg('%s: %d files' % (snapshot_id,
+                                            len(snapshot['files'])),
+                          colors.BLUE)
+                for path in sorted(snapshot['files']):
+                    print path
+        elif args.backups_command == 'restore':
+            for path in self.store.restore(args.snapshot, args.paths or None):
+                print_msg('Restored ' + path, colors.GREEN)
+        elif args.backups_command == 'gc':
+            max_age = args.max_age * 86400 if args.max_age is not None \
+                else None
+            snapshots, objects = self.store.gc(args.keep, max_age)
+            print_msg('Deleted %d snapshots and %d objects'
+                      % (snapshots, objects), colors.BLUE)
+        else:
+            raise ValueError("Argument required for backups subcommand")
+
+
+class InstallState:
+    """Records a hash of each category's package list when the category was
+    installed successfully, so later installs can skip it while neither the
+    list nor the installed packages changed"""
+    VERSION = 1
+
+    def __init__(self, path):
+        self.path = path
+        # Maps each category to its (package list hash, install time)
+        self.categories = load_cache(path, self.VERSION) or {}
+
+    @staticmethod
+    def hash_packages(packages):
+        return hashlib.sha1('\n'.join(sorted(packages))).hexdigest()
+
+    def is_unchanged(self, category, packages):
+        entry = self.categories.get(category)
+        return entry is not None and entry[0] == self.hash_packages(packages)
+
+    def record(self, packages, categories):
+        now = time.time()
+        for category in categories:
+            self.categories[category] = (self.hash_packages(packages[category]),
+                                         now)
+        save_cache(self.path, self.VERSION, self.categories)
+
+
+def get_install_state_path(dbpath):
+    return get_cache_path('install-state', dbpath)
+
+
+def get_sync_stamp_path(dbpath):
+    return get_cache_path('sync-stamp', dbpath)
 
-                if retcode != 0:
-                    bad_packages.append(p)
+
+class InstallHandler:
+    def __init__(self, pacman, dbpath=None, aur_snapshot=None,
+                 aur_jobs=4, pacman_config=None):
+        self.pacman = pacman
+        self.pacman_config = pacman_config
+        if dbpath is None:
+            dbpath = (pacman_config.dbpath if pacman_config is not None
+                      else DEFAULT_DBPATH)
+        self.dbpath = dbpath
+        self.aur_snapshot = aur_snapshot
+        self.aur_jobs = aur_jobs
+
+    def get_repos(self):
+        """Returns the enabled repos, or None to use every sync database when
+        pacman.conf wasn't read"""
+        if self.pacman_config is None:
+            return None
+        return self.pacman_config.enabled_repos()
+
+    def get_missing_packages(self, package_list):
+        """Returns the packages in `package_list` that aren't in any sync
+        database"""
+        try:
+            with tracer.phase('load sync index'):
+                index = SyncPackageDB(self.dbpath, repos=self.get_repos())
+        except (tarfile.TarError, IOError) as e:
+            print_msg('Could not read the sync databases (%s), falling back '
+                      'to pacman' % e, colors.YELLOW)
+            # The package and group lookups don't depend on each other
+            (_, all_packages), (_, all_groups) = parallel_imap(
+                tracer.communicate, [[self.pacman, '-Ssq'], ['pacman', '-Sg']],
+                2)
+            return (set(package_list) - set(all_packages.split('\n'))
+                    - set(all_groups.split('\n')))
+
+        return set(p for p in package_list if not index.contains(p))
+
+    def uses_aur_helper(self):
+        return os.path.basename(self.pacman) != 'pacman'
+
+    def get_aur_resolver(self):
+        return AURResolver(self.pacman, self.aur_snapshot, self.aur_jobs)
+
+    def check_packages_exist(self, packages, categories, resolver=None):
+        package_list = [p for c in categories for p in packages[c]]
+
+        missing_packages = self.get_missing_packages(package_list)
+
+        # Fallback to checking the AUR if pacman is not used, in case the
+        # missing packages are actually in the AUR
+        if self.uses_aur_helper():
+            if resolver is None:
+                resolver = self.get_aur_resolver()
+            with tracer.phase('resolve AUR packages'):
+                bad_packages = resolver.resolve(missing_packages)
+            self.print_aur_timings(resolver.timings)
         else:
             bad_packages = missing_packages
 
         return bad_packages
 
+    def print_aur_timings(self, timings):
+        for package, (source, elapsed) in sorted(timings.iteritems()):
+            printc('%s: checked with %s in %.3fs' % (package, source, elapsed),
+                   colors.BLUE)
+
     def check_required_repos(self):
-        repos = []
-        f = open('/etc/pacman.conf').read()
-        for repo in config.required_repos:
-            if re.search(r'\[%s\]' % repo, f, re.MULTILINE) == None:
-                repos.add(repo)
-        return repos
+        """Returns the repos in `config.required_repos` that aren't enabled"""
+        pacman_config = self.pacman_config or PacmanConfig()
+        enabled = set(pacman_config.enabled_repos())
+        return [repo for repo in config.required_repos if repo not in enabled]
+
+    def should_update_repos(self, refresh=None, max_age=None):
+        """Returns whether the sync databases need to be updated, and why.
+        `refresh` forces the decision either way, otherwise they're updated
+        unless all of them were synced less than `max_age` seconds ago.
+
+        pacman sets the mtime of each database to the mirror's Last-Modified
+        time, so the time of the last successful update_repos is used too."""
+        if refresh is not None:
+            return refresh, ('--refresh was given' if refresh
+                             else '--no-refresh was given')
+        if max_age is None:
+            return True, 'sync_max_age is not set in config.py'
+
+        db_files = get_sync_db_files(os.path.join(self.dbpath, 'sync'),
+                                     self.get_repos())
+        if not db_files:
+            return True, 'there are no sync databases'
+        synced = min(os.stat(f).st_mtime for f in db_files)
+        try:
+            synced = max(synced,
+                         os.stat(get_sync_stamp_path(self.dbpath)).st_mtime)
+        except OSError:
+            pass
+        age = time.time() - synced
+        if age > max_age:
+            return True, ('the sync databases were last updated %ds ago, '
+                          'more than sync_max_age (%ds)' % (age, max_age))
+        return False, ('the sync databases were updated %ds ago, within '
+                       'sync_max_age (%ds)' % (age, max_age))
 
     def update_repos(self):
-        dev_null = open(os.devnull, 'w')
         printc('Updating package database, enter sudo password if prompted',
                colors.YELLOW)
-        return subprocess.call(['sudo', self.pacman, '-Sy'], stdout=dev_null) == 0
+        # Run through `processes` so a failed install pipeline can stop it
+        returncode, _ = tracer.communicate(['sudo', self.pacman, '-Sy'])
+        if returncode != 0:
+            return False
+        self.record_sync()
+        return True
+
+    def record_sync(self):
+        """Records that the sync databases were just updated"""
+        path = get_sync_stamp_path(self.dbpath)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        open(path, 'w').close()
 
     # TODO: Function shouldn't need to know about test code,
     # but I can't figure out any other way :(
-    def do_install(self, packages, categories, test=False):
+    def do_install(self, packages, categories, test=False, options=()):
         package_list = []
         for category in categories:
             package_list += packages[category]
@@ -326,56 +2736,585 @@ class InstallHandler:
         if os.path.basename(command[0]) == 'pacman':
             command.insert(0, 'sudo')
 
+        command.extend(options)
         command.extend(package_list)
-        subprocess.check_call(command)
+        tracer.call(subprocess.check_call, command)
 
-    def handle(self, args):
-        # Make sure all required repos are available
-        if does_var_exist('required_repos', list):
-            repos = self.check_required_repos()
-            if len(repos) > 0:
-                print_msg('The following repos must be enabled before package '
-                          'installation can continue: ' + ', '.join(repos),
-                          colors.RED)
-                return
+    def get_pending_packages(self, packages, categories, state):
+        """Returns a dict mapping each category in `categories` that needs to be
+        installed to its packages that aren't installed yet. Categories whose
+        package list is unchanged since they were last installed are left out
+        while all their packages (or groups) are still installed."""
+        index = LocalPackageDB(self.dbpath)
+        groups = index.groups()
 
-        if not self.update_repos():
-            print_msg('Failed to update package database', colors.RED)
+        def installed(p):
+            return p in index.packages or index.resolve(p) is not None
+
+        pending = {}
+        for category in categories:
+            if (state.is_unchanged(category, packages[category])
+                    and all(installed(p) or p in groups
+                            for p in packages[category])):
+                continue
+            # Groups are always passed on, pacman installs their missing
+            # members
+            pending[category] = [p for p in packages[category]
+                                 if not installed(p)]
+        return pending
+
+    def prefetch(self, packages, categories, jobs):
+        """Downloads the repo packages that aren't installed yet and returns
+        the options do_install needs to use them"""
+        local = LocalPackageDB(self.dbpath)
+        sync = SyncPackageDB(self.dbpath, repos=self.get_repos())
+        # Packages only in the AUR are left to the AUR helper
+        targets = set(p for c in categories for p in packages[c]
+                      if p not in local.packages and sync.contains(p))
+
+        cache_dirs = (self.pacman_config.cache_dirs
+                      if self.pacman_config is not None else None)
+        prefetcher = Prefetcher(cache_dirs, jobs=jobs)
+        try:
+            downloaded = prefetcher.prefetch(targets)
+        except (subprocess.CalledProcessError, OSError) as e:
+            printc('Skipping prefetch, failed to get the package URLs: %s' % e,
+                   colors.YELLOW)
+            return prefetcher.install_options()
+        for filename in downloaded:
+            size, elapsed = prefetcher.timings[filename]
+            printc('Downloaded %s (%d bytes) in %.3fs'
+                   % (filename, size, elapsed), colors.BLUE)
+        for filename, error in sorted(prefetcher.errors.iteritems()):
+            printc('Failed to download %s, leaving it to pacman: %s'
+                   % (filename, error), colors.YELLOW)
+        return prefetcher.install_options()
+
+    def require_repos(self):
+        repos = self.check_required_repos()
+        if len(repos) > 0:
+            raise PipelineFailed('The following repos must be enabled before '
+                                 'package installation can continue: '
+                                 + ', '.join(repos))
+
+    def refresh_repos(self, refresh):
+        max_age = None
+        if does_var_exist('sync_max_age', int):
+            max_age = config.sync_max_age
+        update, reason = self.should_update_repos(refresh, max_age)
+        if not update:
+            printc('Skipping package database update: ' + reason, colors.BLUE)
             return
+        printc('Updating package database: ' + reason, colors.BLUE)
+        if not self.update_repos():
+            raise PipelineFailed('Failed to update package database')
         print_msg('Update successful', colors.BLUE)
 
-        # Get list of categories to install
-        categories = None
-        if args.categories != None:
-            categories = args.categories
-            for category in categories:
-                if category not in config.packages:
-                    print_msg('Package category %s does not exist' % category,
-                    colors.RED)
-                    return
-        else:
-            categories = config.packages.keys()
+    def get_categories(self, categories):
+        if categories is None:
+            return config.packages.keys()
+        for category in categories:
+            if category not in config.packages:
+                raise PipelineFailed('Package category %s does not exist'
+                                     % category)
+        return categories
+
+    def verify_packages(self, categories, resolver):
+        printc('Checking that all packages exist... (this may take a while '
+               'the pacman variable in config.py is set to anything other '
+               'than pacman)', colors.YELLOW)
+        bad_packages = self.check_packages_exist(config.packages, categories,
+                                                 resolver)
+        if len(bad_packages) > 0:
+            raise PipelineFailed('The following packages could not be found in '
+                                 'the repos and must be removed before '
+                                 'installation can continue: '
+                                 + ', '.join(bad_packages))
 
+    def handle(self, args):
+        # The checks that don't depend on each other run concurrently, and the
+        # first one to fail stops the others
+        pipeline = Pipeline()
+        if does_var_exist('required_repos', list):
+            pipeline.add('check_required_repos', self.require_repos)
+        pipeline.add('validate categories',
+                     lambda: self.get_categories(args.categories))
+        pipeline.add('update_repos', lambda: self.refresh_repos(args.refresh))
         if not args.skip_verification:
-            # Make sure all packages to be installed exist
-            printc('Checking that all packages exist... (this may take a while '
-                   'the pacman variable in config.py is set to anything other '
-                   'than pacman)', colors.YELLOW)
-            bad_packages = self.check_packages_exist(config.packages, categories)
-            if len(bad_packages) > 0:
-                print_msg('The following packages could not be found in the repos '
-                          'and must be removed before installation can continue: '
-                          + ', '.join(bad_packages), colors.RED)
-                return
+            resolver = None
+            if self.uses_aur_helper():
+                resolver = self.get_aur_resolver()
+                # Loading the AUR snapshot doesn't need the updated databases
+                pipeline.add('load AUR snapshot', resolver.get_snapshot)
+            pipeline.add('check_packages_exist',
+                         lambda categories, *_: self.verify_packages(
+                             categories, resolver),
+                         deps=['validate categories', 'update_repos']
+                         + (['load AUR snapshot'] if resolver else []))
+        try:
+            results = pipeline.run()
+        except PipelineFailed as e:
+            print_msg(str(e), colors.RED)
+            return
+        categories = results['validate categories']
+
+        state = InstallState(get_install_state_path(self.dbpath))
+        packages = config.packages
+        if not args.force:
+            with tracer.phase('get pending packages'):
+                packages = self.get_pending_packages(config.packages,
+                                                     categories, state)
+            skipped = [c for c in categories if c not in packages]
+            if skipped:
+                printc('Skipping unchanged categories: ' + ', '.join(
+                    sorted(skipped)), colors.BLUE)
+        pending = [c for c in categories if packages.get(c)]
+        if not pending:
+            print_msg('Nothing to install', colors.BLUE)
+            state.record(config.packages, categories)
+            return
+
+        options = []
+        if args.prefetch:
+            print_msg('Downloading packages', colors.BLUE)
+            with tracer.phase('prefetch'):
+                options = self.prefetch(packages, pending,
+                                        args.prefetch_jobs)
 
         print_msg('Installing packages', colors.BLUE)
-        self.do_install(config.packages, categories)
+        with tracer.phase('do_install'):
+            self.do_install(packages, pending, options=options)
+        state.record(config.packages, categories)
         print_msg('Install complete', colors.BLUE)
 
 
+def read_roots_file(path):
+    """Returns the root directories listed one per line in `path`, skipping
+    blank lines and # comments"""
+    roots = []
+    with open(path) as f:
+        for line in f:
+            line = line.split('#', 1)[0].strip()
+            if line:
+                roots.append(line)
+    return roots
+
+
+def get_roots(args):
+    roots = list(args.root or [])
+    if args.roots_file is not None:
+        roots.extend(read_roots_file(args.roots_file))
+    return roots
+
+
+def list_root(item):
+    """Returns the root and its differing packages, or the error reading
+    them. Runs in a FleetHandler worker process."""
+    root, categories, inverse = item
+    try:
+        handler = ListHandler(get_dbpath(root))
+        return root, sorted(handler.get_differing_packages(categories,
+                                                          inverse)), None
+    except (IOError, OSError) as e:
+        return root, None, str(e)
+
+
+def config_diff_root(item):
+    """Returns the root and the descriptions of its differing config files,
+    or the error comparing them. Runs in a FleetHandler worker process."""
+    root, configs_dir, jobs = item
+    config_files = dict(
+        (f, os.path.join(root, os.path.expanduser(p).lstrip('/')))
+        for f, p in config.config_files.iteritems())
+    try:
+        handler = ConfigHandler(configs_dir, jobs=jobs,
+                                expander=PatternExpander(get_config_ignore()))
+        return root, [(os.path.relpath(r.backup_config_path, configs_dir),
+                       handler.describe_result(r)[0])
+                      for r in handler.config_diff(configs_dir, config_files)
+                      if r.result != ConfigHandler.DiffResult.MATCHES], None
+    except (IOError, OSError) as e:
+        return root, None, str(e)
+
+
+class FleetHandler:
+    """Runs `list` or `config -d` against many root directories, one worker
+    process per root, and prints one report for all of them. The workers are
+    forked, so they inherit the loaded config."""
+
+    def __init__(self, roots, processes=None):
+        self.roots = roots
+        self.processes = processes or min(len(roots),
+                                          multiprocessing.cpu_count())
+
+    def map(self, func, items):
+        pool = multiprocessing.Pool(self.processes)
+        try:
+            return pool.map(func, items)
+        finally:
+            pool.close()
+            pool.join()
+
+    def list_report(self, categories, inverse):
+        """Returns a dict with the differing packages of each root, the errors
+        of roots that couldn't be read and the packages differing on every
+        root"""
+        results = self.map(list_root, [(root, categories, inverse)
+                                       for root in self.roots])
+        return self.make_report(results)
+
+    def config_report(self, configs_dir, jobs):
+        """Returns a dict with the config files that differ from or don't
+        exist in each root, the errors of roots that couldn't be compared and
+        the config files differing on every root"""
+        results = self.map(config_diff_root, [(root, configs_dir, jobs)
+                                              for root in self.roots])
+        report = self.make_report(
+            [(root, [f for f, _ in entries] if entries is not None else None,
+              error) for root, entries, error in results])
+        report['roots'] = dict((root, [message for _, message in entries])
+                               for root, entries, error in results
+                               if entries is not None)
+        return report
+
+    def make_report(self, results):
+        roots = dict((root, items) for root, items, error in results
+                     if items is not None)
+        errors = dict((root, error) for root, _, error in results
+                      if error is not None)
+        common = (sorted(set.intersection(*[set(i) for i in roots.values()]))
+                  if roots else [])
+        return {'roots': roots, 'errors': errors, 'common': common}
+
+    def print_report(self, report, common_title):
+        if output.format != 'text':
+            for root in self.roots:
+                output.record('root', None, root=root,
+                              items=report['roots'].get(root),
+                              error=report['errors'].get(root))
+            output.record('common', None, items=report['common'])
+            return
+
+        for root in self.roots:
+            if root in report['errors']:
+                print_msg(root + ': ' + report['errors'][root], colors.RED)
+            else:
+                print_msg(root, colors.BLUE)
+                for item in report['roots'][root]:
+                    print item
+        print_msg(common_title, colors.BLUE)
+        for item in report['common']:
+            print item
+
+
+class Inotify:
+    """Minimal ctypes binding for Linux's inotify"""
+    IN_MODIFY = 0x2
+    IN_ATTRIB = 0x4
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_DELETE_SELF = 0x400
+    IN_MOVE_SELF = 0x800
+    IN_CLOEXEC = 0o2000000
+    MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM
+            | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+            | IN_MOVE_SELF)
+
+    def __init__(self):
+        if _libc is None or not hasattr(_libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        self.fd = _libc.inotify_init1(self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+        self.watches = {}
+
+    def add_watch(self, path):
+        wd = _libc.inotify_add_watch(self.fd, path, self.MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()),
+                          path)
+        self.watches[wd] = path
+
+    def close(self):
+        os.close(self.fd)
+
+    def read_paths(self):
+        """Blocks until there are events and returns the changed paths"""
+        data = os.read(self.fd, 1 << 16)
+        paths = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = struct.unpack_from('iIII', data, offset)
+            offset += 16
+            name = data[offset:offset + length].rstrip('\0')
+            offset += length
+            if wd in self.watches:
+                paths.append(os.path.join(self.watches[wd], name)
+                             if name else self.watches[wd])
+        return paths
+
+
+class PollingWatcher:
+    """Stands in for Inotify where it isn't available by comparing the stat
+    signatures of the watched paths every `interval` seconds"""
+
+    def __init__(self, interval=2):
+        self.interval = interval
+        self.signatures = {}
+
+    def signature(self, path):
+        try:
+            return stat_signature(path)
+        except OSError:
+            return None
+
+    def add_watch(self, path):
+        self.signatures[path] = self.signature(path)
+
+    def close(self):
+        pass
+
+    def read_paths(self):
+        while True:
+            time.sleep(self.interval)
+            paths = []
+            for path, old in self.signatures.items():
+                new = self.signature(path)
+                if new != old:
+                    self.signatures[path] = new
+                    paths.append(path)
+            if paths:
+                return paths
+
+
+def is_related_path(path1, path2):
+    """Returns whether either path is the same as or inside the other"""
+    return (path1 == path2 or path1.startswith(path2.rstrip('/') + '/')
+            or path2.startswith(path1.rstrip('/') + '/'))
+
+
+def get_socket_path():
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime_dir:
+        return os.path.join(runtime_dir, 'archutil.sock')
+    return '/tmp/archutil-%d.sock' % os.getuid()
+
+
+class Daemon:
+    """Keeps the package indexes and the config diff results in memory and
+    answers queries from them. Watched paths are reported to `invalidate`,
+    which only drops the state depending on them."""
+
+    def __init__(self, config_file_path, configs_dir, dbpath, jobs=4,
+                 use_config_cache=True):
+        self.config_file_path = os.path.abspath(config_file_path)
+        self.configs_dir = os.path.abspath(configs_dir)
+        self.dbpath = os.path.abspath(dbpath)
+        self.local_dir = os.path.join(self.dbpath, 'local')
+        self.sync_dir = os.path.join(self.dbpath, 'sync')
+        self.use_config_cache = use_config_cache
+        self.config_handler = ConfigHandler(
+            self.configs_dir, ConfigManifest(get_manifest_path(configs_dir)),
+            jobs)
+        self.lock = threading.Lock()
+        self.local_index = None
+        self.sync_index = None
+        self.config_files = None
+        self.diff_results = {}
+        self.reload_config()
+
+    def reload_config(self):
+        global config
+        config = load_config(self.config_file_path, self.use_config_cache)
+        self.config_handler.expander = get_pattern_expander(self.configs_dir)
+        self.local_index = None
+        self.config_files = None
+        self.diff_results = {}
+
+    def get_config_files(self):
+        if self.config_files is None:
+            self.config_files = self.config_handler.expander.expand(
+                self.configs_dir, config.config_files)
+        return self.config_files
+
+    def watched_paths(self):
+        """Returns the paths to watch. Watches aren't recursive, so every
+        directory a pattern was expanded in is watched. Missing paths are
+        replaced by their nearest existing parent, so their creation is noticed
+        too."""
+        paths = set([self.dbpath, self.local_dir, self.sync_dir,
+                     os.path.dirname(self.config_file_path), self.configs_dir])
+        with self.lock:
+            expander = self.config_handler.expander
+            for f, system_config_path in config.config_files.iteritems():
+                system_config_path = os.path.expanduser(system_config_path)
+                backup_config_path = os.path.join(self.configs_dir, f)
+                if is_pattern(system_config_path):
+                    base, pattern = split_pattern(system_config_path)
+                    paths.update(expander.walked_dirs(base, pattern))
+                    paths.update(expander.walked_dirs(backup_config_path,
+                                                      pattern))
+                    paths.add(os.path.dirname(base))
+                    paths.add(os.path.dirname(backup_config_path))
+                    continue
+                for path in (backup_config_path, system_config_path):
+                    if os.path.isdir(path):
+                        paths.add(path)
+                    paths.add(os.path.dirname(path))
+
+        watched = set()
+        for path in paths:
+            while not os.path.isdir(path) and path != os.path.dirname(path):
+                path = os.path.dirname(path)
+            watched.add(path)
+        return sorted(watched)
+
+    def invalidate(self, path):
+        with self.lock:
+            if path == self.config_file_path:
+                self.reload_config()
+                return
+            # pacman removes db.lck at the end of every transaction, including
+            # ones that only edit files inside local/<package>/
+            if (is_related_path(path, self.local_dir)
+                    or path == os.path.join(self.dbpath, 'db.lck')):
+                self.local_index = None
+            if (is_related_path(path, self.sync_dir)
+                    or path == os.path.join(self.dbpath, 'db.lck')):
+                self.sync_index = None
+            for f, system_config_path in config.config_files.iteritems():
+                system_config_path = os.path.expanduser(system_config_path)
+                if (is_related_path(path, os.path.join(self.configs_dir, f))
+                        or is_related_path(path,
+                                           pattern_base(system_config_path))):
+                    for key in self.diff_results.keys():
+                        if is_related_path(key, f):
+                            del self.diff_results[key]
+                    # Files matching the pattern may have come or gone
+                    if is_pattern(system_config_path):
+                        self.config_files = None
+
+    def query(self, command):
+        """Answers `list`, `list -i`, `config -d`, `check PACKAGE...` or
+        `ping`"""
+        words = command.split()
+        with self.lock:
+            if words in (['list'], ['list', '-i'], ['list', '--inverse']):
+                if self.local_index is None:
+                    self.local_index = LocalPackageDB(self.dbpath)
+                handler = ListHandler(self.dbpath)
+                handler.index = self.local_index
+                return handler.format_packages(handler.get_differing_packages(
+                    config.packages.keys(), len(words) > 1), False)
+            elif words == ['config', '-d']:
+                config_files = self.get_config_files()
+                missing = dict((f, p) for f, p in config_files.iteritems()
+                               if f not in self.diff_results)
+                for r in self.config_handler.config_diff(self.configs_dir,
+                                                         missing):
+                    f = os.path.relpath(r.backup_config_path, self.configs_dir)
+                    self.diff_results[f] = r
+                return '\n'.join(
+                    self.config_handler.describe_result(
+                        self.diff_results[f])[0]
+                    for f in sorted(config_files))
+            elif words and words[0] == 'check':
+                if self.sync_index is None:
+                    self.sync_index = SyncPackageDB(self.dbpath)
+                return '\n'.join(p for p in words[1:]
+                                 if not self.sync_index.contains(p))
+            elif words == ['ping']:
+                return 'pong'
+            else:
+                return 'error: unknown query %r' % command
+
+    def watch(self, watcher):
+        """Invalidates state as `watcher` reports changes, forever"""
+        watched = set()
+        while True:
+            for path in self.watched_paths():
+                if path not in watched:
+                    try:
+                        watcher.add_watch(path)
+                        watched.add(path)
+                    except OSError:
+                        pass
+            for path in watcher.read_paths():
+                self.invalidate(path)
+
+    def serve(self, socket_path):
+        daemon = self
+
+        class RequestHandler(SocketServer.StreamRequestHandler):
+            def handle(self):
+                command = self.rfile.readline().strip()
+                try:
+                    response = daemon.query(command)
+                except Exception as e:
+                    response = 'error: %s' % e
+                self.wfile.write(response + '\n')
+
+        try:
+            watcher = Inotify()
+        except OSError:
+            print_msg('inotify is not available, polling for changes instead',
+                      colors.YELLOW)
+            watcher = PollingWatcher()
+        t = threading.Thread(target=self.watch, args=(watcher,))
+        t.daemon = True
+        t.start()
+
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = SocketServer.ThreadingUnixStreamServer(socket_path,
+                                                        RequestHandler)
+        server.daemon_threads = True
+        os.chmod(socket_path, 0600)
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        print_msg('Listening on ' + socket_path, colors.BLUE)
+        try:
+            server.serve_forever()
+        finally:
+            # Stop watching first so removing the socket isn't reported to a
+            # thread of an interpreter that is shutting down
+            watcher.close()
+            server.server_close()
+            os.remove(socket_path)
+
+
+def query_daemon(socket_path, command):
+    """Sends `command` to a running `archutil serve` and returns its
+    response"""
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.connect(socket_path)
+        s.sendall(command + '\n')
+        chunks = []
+        for chunk in iter(lambda: s.recv(1 << 16), ''):
+            chunks.append(chunk)
+        return ''.join(chunks)
+    finally:
+        s.close()
+
+
 def parse_arguments():
     parser = argparse.ArgumentParser(description="Package management utility")
     parser.add_argument('-c', '--config-path', help='Path to configy.py')
+    parser.add_argument('--no-config-cache', action='store_true',
+                        help="Don't use or update the cached copy of the config")
+    parser.add_argument('--timings', action='store_true',
+                        help=('Print the time spent in each phase and '
+                              'subprocess call to stderr'))
+    parser.add_argument('--trace', metavar='FILE',
+                        help=('Write the timings to FILE in the Chrome trace '
+                              'event format'))
+    parser.add_argument('--format', choices=Output.FORMATS, default='text',
+                        help=('Output format. json and jsonl write one JSON '
+                              'record per package, config file or message '
+                              'as soon as it is known.'))
     subparsers = parser.add_subparsers(dest='subcommand')
 
     install_parser = subparsers.add_parser(
@@ -386,6 +3325,32 @@ def parse_arguments():
                                 "install"))
     install_parser.add_argument('--categories', nargs='+',
                                 help='Package categories to install')
+    install_parser.add_argument('--aur-snapshot',
+                                help=('Path to a local AUR metadata dump '
+                                      '(packages-meta-v1.json.gz or '
+                                      'packages.gz) used to verify AUR '
+                                      'packages'))
+    install_parser.add_argument('--aur-jobs', type=int, default=4,
+                                help=('Number of concurrent AUR helper '
+                                      'searches for packages not in the '
+                                      'snapshot'))
+    refresh_group = install_parser.add_mutually_exclusive_group()
+    refresh_group.add_argument('--refresh', action='store_true', default=None,
+                               help=('Always update the package database, '
+                                     'even if it was recently synced'))
+    refresh_group.add_argument('--no-refresh', action='store_false',
+                               dest='refresh',
+                               help="Don't update the package database")
+    install_parser.add_argument('-p', '--prefetch', action='store_true',
+                                help=('Download missing packages concurrently '
+                                      'before starting the install'))
+    install_parser.add_argument('--prefetch-jobs', type=int, default=4,
+                                help='Number of concurrent downloads')
+    install_parser.add_argument('-f', '--force', action='store_true',
+                                help=('Pass every package to the package '
+                                      'manager, even in categories that '
+                                      'are unchanged since they were last '
+                                      'installed'))
 
     list_parser = subparsers.add_parser(
         'list',
@@ -400,9 +3365,46 @@ def parse_arguments():
     list_parser.add_argument(
         '-l', '--list', action='store_true',
         help='Display output as a Python list')
+    list_parser.add_argument(
+        '-d', '--deps', action='store_true',
+        help=('Report listed packages that are pulled in as dependencies, '
+              'unlisted packages only needed by listed ones, orphaned '
+              'dependencies and the dependency closure of each category'))
+    list_parser.add_argument(
+        '-r', '--root', action='append',
+        help=('Read the package database of the system installed at this '
+              'path. Can be given several times to check each root.'))
+    list_parser.add_argument(
+        '--roots-file',
+        help='File listing root directories to check, one per line')
+    list_parser.add_argument(
+        '-b', '--dbpath',
+        help='Path to the pacman database (default: %s)' % DEFAULT_DBPATH)
+    list_parser.add_argument(
+        '--incremental', action='store_true',
+        help=('Update a snapshot of the installed packages from the new '
+              'lines in pacman.log instead of reading the whole database'))
+    list_parser.add_argument(
+        '--logfile',
+        help='Path to pacman.log (default: %s)' % DEFAULT_LOGFILE)
 
     config_parser = subparsers.add_parser(
         'config', help="Operations dealing with configuration files")
+    config_parser.add_argument(
+        '-j', '--jobs', type=int, default=4,
+        help='Number of config files to compare concurrently')
+    config_parser.add_argument(
+        '-r', '--root', action='append',
+        help=('Compare against (with -d) or scan (with --scan) the system '
+              'installed at this path. Can be given several times to check '
+              'each root.'))
+    config_parser.add_argument(
+        '--roots-file',
+        help='File listing root directories to compare, one per line')
+    config_parser.add_argument(
+        '--max-diff-size', type=int,
+        help=('Maximum number of bytes of diff output to display per file '
+              '(default: %d)' % DEFAULT_MAX_DIFF_SIZE))
     config_parser.add_argument(
         '-cd', '--configs-dir',
         help='Path to directory where configuration files are stored',
@@ -417,12 +3419,79 @@ def parse_arguments():
                                help="Install config files on system")
     group.add_argument('-u', '--update', action='store_true',
                                help="Update config files in backup folder")
+    group.add_argument('--plan', metavar='FILE',
+                       help=('Write the action (update, install, skip or '
+                             'conflict) for every config file to FILE '
+                             'without changing anything'))
+    group.add_argument('--apply', metavar='PLAN',
+                       help=('Run the actions in a plan written by --plan, '
+                             'skipping files that changed since'))
+    group.add_argument('--scan', action='store_true',
+                       help=('List files that differ from what their package '
+                             'shipped, as candidate config_files entries'))
+    config_parser.add_argument(
+        '--scan-prefix', nargs='+', default=['etc/'],
+        help='Paths, relative to the root, --scan looks under (default: etc/)')
+    config_parser.add_argument(
+        '--policy', choices=['system', 'backup'],
+        help=('Keep this side of the files that differ, after the rules in '
+              '`config_policy`'))
+    config_parser.add_argument(
+        '--atomic', action='store_true',
+        help=('With -i, write every file to a temporary file first and only '
+              'rename them into place once all of them are on disk'))
+
+    backups_parser = subparsers.add_parser(
+        'backups', help='Operations on the backups of installed-over files')
+    backups_parser.add_argument(
+        '-cd', '--configs-dir',
+        help='Path to directory where configuration files are stored',
+        default='config_files')
+    backups_subparsers = backups_parser.add_subparsers(
+        dest='backups_command')
+    backups_subparsers.add_parser('list', help='List the backup snapshots')
+    restore_parser = backups_subparsers.add_parser(
+        'restore', help='Restore the files backed up in a snapshot')
+    restore_parser.add_argument('snapshot', help='Snapshot to restore')
+    restore_parser.add_argument(
+        'paths', nargs='*',
+        help='Only restore these files or the files under these directories')
+    gc_parser = backups_subparsers.add_parser(
+        'gc', help=('Delete old snapshots and the backed up files only they '
+                    'refer to. Without options, only unreferenced files are '
+                    'deleted.'))
+    gc_parser.add_argument('--keep', type=int,
+                           help='Keep this many of the newest snapshots')
+    gc_parser.add_argument('--max-age', type=float,
+                           help='Keep snapshots younger than this many days')
+
+    serve_parser = subparsers.add_parser(
+        'serve', help=('Keeps package and config state in memory and answers '
+                       'queries over a Unix socket'))
+    serve_parser.add_argument('--socket', default=get_socket_path(),
+                              help='Path of the Unix socket to listen on')
+    serve_parser.add_argument(
+        '-cd', '--configs-dir',
+        help='Path to directory where configuration files are stored',
+        default='config_files')
+    serve_parser.add_argument('-b', '--dbpath', default=DEFAULT_DBPATH,
+                              help='Path to the pacman database')
+
+    query_parser = subparsers.add_parser(
+        'query', help='Sends a query to a running `archutil serve`')
+    query_parser.add_argument('--socket', default=get_socket_path(),
+                              help='Path of the Unix socket to connect to')
+    query_parser.add_argument(
+        'query', nargs=argparse.REMAINDER,
+        help='`list`, `list -i`, `config -d`, `check PACKAGE...` or `ping`')
 
     return parser.parse_args()
 
 
-def does_var_exist(var_name, t):
-    return hasattr(config, var_name) and type(getattr(config, var_name)) == t
+def does_var_exist(var_name, t, c=None):
+    if c is None:
+        c = config
+    return hasattr(c, var_name) and type(getattr(c, var_name)) == t
 
 
 def validate_config_file():
@@ -438,11 +3507,110 @@ def validate_config_file():
             and check_var_exists('config_files', dict))
 
 
+# The config variables archutil reads, which are all that's kept when a config
+# file is cached
+CONFIG_VARS = [('packages', dict), ('config_files', dict),
+               ('required_repos', list), ('pacman', str), ('configs_dir', str),
+               ('aur_snapshot', str), ('max_diff_size', int),
+               ('sync_max_age', int), ('config_ignore', list),
+               ('config_policy', list)]
+CONFIG_CACHE_VERSION = 1
+
+
+class Config:
+    """Holds the variables of a config that was read from the cache or from
+    a JSON or TOML file instead of being executed"""
+    def __init__(self, values):
+        self.__dict__.update(values)
+
+
+def to_str(value):
+    """Converts the unicode strings in a decoded JSON or TOML value to str,
+    which is what `does_var_exist` checks for"""
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, list):
+        return [to_str(v) for v in value]
+    if isinstance(value, dict):
+        return dict((to_str(k), to_str(v)) for k, v in value.iteritems())
+    return value
+
+
+def read_config_file(config_file_path):
+    """Returns the config in `config_file_path`. JSON and TOML files are
+    parsed, anything else is executed as Python."""
+    ext = os.path.splitext(config_file_path)[1]
+    if ext == '.json':
+        with open(config_file_path) as f:
+            return Config(to_str(json.load(f)))
+    if ext == '.toml':
+        try:
+            import toml
+        except ImportError:
+            print_msg('The toml module is required to read %s'
+                      % config_file_path, colors.RED)
+            sys.exit(1)
+        return Config(to_str(toml.load(config_file_path)))
+    # Execute into a fresh module, so variables removed from the file since an
+    # earlier load in this process don't linger
+    c = imp.new_module('config')
+    c.__file__ = config_file_path
+    execfile(config_file_path, c.__dict__)
+    return c
+
+
+def load_config(config_file_path, use_cache=True):
+    """Returns the config in `config_file_path`, using a cached copy of its
+    variables if the file's mtime and size, or else its hash, haven't changed.
+
+    JSON and TOML configs are always cached. Python configs can compute their
+    variables at runtime, so they are only cached if they set
+    `cache_config = True`."""
+    cache_path = get_cache_path('config', config_file_path)
+    st = os.stat(config_file_path)
+
+    digest = None
+    cached = None
+    if use_cache:
+        cached = load_cache(cache_path, CONFIG_CACHE_VERSION)
+    if cached is not None:
+        mtime, size, cached_digest, values = cached
+        if (mtime, size) == (st.st_mtime, st.st_size):
+            return Config(values)
+        digest = hash_file(config_file_path)
+        if digest == cached_digest:
+            save_cache(cache_path, CONFIG_CACHE_VERSION,
+                       (st.st_mtime, st.st_size, digest, values))
+            return Config(values)
+
+    c = read_config_file(config_file_path)
+    cacheable = (isinstance(c, Config)
+                 or getattr(c, 'cache_config', False) is True)
+    if (use_cache and cacheable and does_var_exist('packages', dict, c)
+            and does_var_exist('config_files', dict, c)):
+        if digest is None:
+            digest = hash_file(config_file_path)
+        values = dict((name, getattr(c, name)) for name, t in CONFIG_VARS
+                      if does_var_exist(name, t, c))
+        save_cache(cache_path, CONFIG_CACHE_VERSION,
+                   (st.st_mtime, st.st_size, digest, values))
+    return c
+
+
+def find_config_file(directory):
+    for name in ('config.py', 'config.json', 'config.toml'):
+        path = os.path.join(directory, name)
+        if os.path.isfile(path):
+            return path
+    return os.path.join(directory, 'config.py')
+
+
 def get_config_file_path(args):
     # First check if config file is in local directory, then check in ~/.config
-    config_file_path = os.path.join(os.getcwd(), 'config.py')
+    config_file_path = find_config_file(os.getcwd())
     if not os.path.isfile(config_file_path):
-        config_file_path = os.path.expanduser('~/.config/archutil/config.py')
+        config_file_path = find_config_file(
+            os.path.expanduser('~/.config/archutil'))
     if args.config_path != None:
         if os.path.isabs(args.config_path):
             config_file_path = args.config_path
@@ -455,6 +3623,26 @@ def get_config_file_path(args):
 
     return config_file_path
 
+def get_config_ignore():
+    if does_var_exist('config_ignore', list):
+        return config.config_ignore
+    return []
+
+
+def get_policy_rules(args):
+    rules = []
+    if does_var_exist('config_policy', list):
+        rules.extend(tuple(rule) for rule in config.config_policy)
+    if args.policy is not None:
+        rules.append(('*', args.policy))
+    return rules
+
+
+def get_pattern_expander(configs_dir):
+    return PatternExpander(get_config_ignore(),
+                           get_cache_path('patterns', configs_dir))
+
+
 def get_configs_dir_path(args, config_file_path):
     if does_var_exist('configs_dir', str):
         if os.path.isabs(args.configs_dir):
@@ -483,24 +3671,113 @@ def get_pacman():
     else:
         return 'pacman'
 
+def get_max_diff_size(args):
+    if args.max_diff_size is not None:
+        return args.max_diff_size
+    if does_var_exist('max_diff_size', int):
+        return config.max_diff_size
+    return DEFAULT_MAX_DIFF_SIZE
+
+def get_aur_snapshot(args):
+    if args.aur_snapshot is not None:
+        return args.aur_snapshot
+    if does_var_exist('aur_snapshot', str):
+        return os.path.expanduser(config.aur_snapshot)
+    return None
+
 def main():
     args = parse_arguments()
+    tracer.enabled = args.timings or args.trace is not None
+    output.format = args.format
+    try:
+        run(args)
+    finally:
+        output.close()
+        if args.timings:
+            tracer.print_summary()
+        if args.trace is not None:
+            tracer.write_trace(args.trace)
+
+def run(args):
+    # Queries don't need the config, that's what keeps them cheap
+    if args.subcommand == 'query':
+        command = ' '.join(args.query)
+        response = query_daemon(args.socket, command)
+        if output.format == 'text':
+            sys.stdout.write(response)
+        else:
+            for line in response.splitlines():
+                output.record('response', None, query=command, line=line)
+        return
+
     config_file_path = get_config_file_path(args)
 
     global config
-    config = imp.load_source('config', config_file_path)
-    validate_config_file()
+    with tracer.phase('load config'):
+        config = load_config(config_file_path, not args.no_config_cache)
+        validate_config_file()
 
     pacman = get_pacman();
 
     handler = None
     if args.subcommand == 'install':
-        handler = InstallHandler(pacman)
+        handler = InstallHandler(pacman, aur_snapshot=get_aur_snapshot(args),
+                                 aur_jobs=args.aur_jobs,
+                                 pacman_config=PacmanConfig())
     elif args.subcommand == 'list':
-        handler = ListHandler()
+        roots = get_roots(args)
+        if len(roots) > 1:
+            categories = args.categories or config.packages.keys()
+            fleet = FleetHandler(roots)
+            with tracer.phase('fleet list'):
+                report = fleet.list_report(categories, args.inverse)
+            fleet.print_report(report, 'Common to all roots')
+            return
+        root = roots[0] if roots else None
+        if root is None and args.dbpath is None:
+            # Without --root, use the paths pacman itself uses
+            pacman_config = PacmanConfig()
+            dbpath, default_logfile = pacman_config.dbpath, pacman_config.logfile
+        else:
+            dbpath, default_logfile = get_dbpath(root, args.dbpath), \
+                get_logfile(root)
+        logfile = None
+        if args.incremental:
+            logfile = args.logfile or default_logfile
+        handler = ListHandler(dbpath, logfile)
     elif args.subcommand == 'config':
+        roots = get_roots(args)
+        # Scans don't use the configs dir, so it doesn't have to exist
+        if args.scan:
+            ScanHandler(roots or ['/']).handle(args)
+            return
+        configs_dir = get_configs_dir_path(args, config_file_path)
+        if roots:
+            if not args.diff:
+                print_msg('--root and --roots-file only work with config -d',
+                          colors.RED)
+                sys.exit(1)
+            fleet = FleetHandler(roots)
+            with tracer.phase('fleet config'):
+                report = fleet.config_report(configs_dir, args.jobs)
+            fleet.print_report(report, 'Differing on all roots')
+            return
+        handler = ConfigHandler(
+            configs_dir, ConfigManifest(get_manifest_path(configs_dir)),
+            args.jobs, get_max_diff_size(args),
+            get_pattern_expander(configs_dir),
+            backup_store=BackupStore(get_backup_store_path(configs_dir)),
+            policy_rules=get_policy_rules(args))
+    elif args.subcommand == 'backups':
+        configs_dir = get_configs_dir_path(args, config_file_path)
+        handler = BackupHandler(
+            BackupStore(get_backup_store_path(configs_dir)))
+    elif args.subcommand == 'serve':
         configs_dir = get_configs_dir_path(args, config_file_path)
-        handler = ConfigHandler(configs_dir)
+        daemon = Daemon(config_file_path, configs_dir, args.dbpath,
+                        use_config_cache=not args.no_config_cache)
+        daemon.serve(args.socket)
+        return
     else:
         raise ValueError("Invalid subcommand")
 
@@ -1,12 +1,30 @@
+# Cache the variables below instead of executing this file on every run. Only
+# enable this if they don't depend on anything outside this file, like the user
+# running archutil or the machine it runs on. The same variables can also be
+# written as a config.json file, which is always cached.
+# cache_config = True
+
 # Non-standard repositories required to install packages
 # required_repos = ['multilib']
 
 # Custom path to directory where configuration files are stored
 # configs_dir = '/path/to/config/files'
 
+# Maximum number of bytes of diff output to display per config file
+# max_diff_size = 1048576
+
+# Skip updating the package database before installing if it was synced
+# less than this many seconds ago
+# sync_max_age = 3600
+
 # Use a package manager other than pacman (i.e. to support the AUR)
 # pacman = 'yaourt'
 
+# Local AUR metadata dump used to verify AUR packages without searching for
+# each one with the package manager above, i.e. a downloaded copy of
+# https://aur.archlinux.org/packages-meta-v1.json.gz
+# aur_snapshot = '~/.cache/aur/packages-meta-v1.json.gz'
+
 # List the packages with their categories below
 packages = {
     'category': ['package1',
@@ -14,7 +32,18 @@ packages = {
 }
 
 # List the name of the file in the config_files folder as the key, and the
-# full path to the file as the value (~ for the home directory is not supported)
+# full path to the file as the value (~ is expanded to the home directory).
+# The path can be a glob pattern, where ** matches any number of directories.
+# Every matching file is then stored under a folder named by the key.
 config_files = {
-    'bashrc': '/home/user/.bashrc'
+    'bashrc': '~/.bashrc',
+    # 'dotconfig': '~/.config/**/*.conf'
 }
+
+# Glob patterns of files and directories that config_files patterns skip
+# config_ignore = ['*.bak', 'cache']
+
+# Which side config --plan keeps for files that differ, as (pattern, side)
+# rules matched against the name or system path of each file. side is
+# 'system' or 'backup'. Files no rule matches are planned as conflicts.
+# config_policy = [('*.conf', 'backup'), ('/etc/*', 'system')]
@@ -0,0 +1,324 @@
+#!/usr/bin/env python2
+
+"""Benchmarks the list, install verification and config handlers against
+synthetic pacman databases and config file sets, so their speed can be
+compared between commits without a real Arch Linux system.
+
+    ./benchmark.py --output before.json
+    (check out another commit)
+    ./benchmark.py --output after.json --compare before.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import StringIO
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+import archutil
+from archutil import ConfigHandler, ConfigManifest, InstallHandler, ListHandler
+
+GROUPS = ['base', 'base-devel', 'xorg', 'gnome', 'kde']
+
+# Stands in for pacman and AUR helpers. Searches print the packages listed in
+# $FAKE_PACMAN_PACKAGES and everything else succeeds without doing anything.
+FAKE_PACMAN = """#!/bin/sh
+case "$1" in
+    -Ssq) if [ -n "$2" ]; then grep -Fx "$2" "$FAKE_PACMAN_PACKAGES"
+          else cat "$FAKE_PACMAN_PACKAGES"; fi ;;
+    -Sg) printf '%s\\n' """ + ' '.join(GROUPS) + """ ;;
+esac
+exit 0
+"""
+
+
+class Config:
+    """Stands in for the module loaded from config.py"""
+    def __init__(self, packages, config_files):
+        self.packages = packages
+        self.config_files = config_files
+
+
+def package_name(i):
+    return 'package%05d' % i
+
+
+def package_groups(i):
+    return [GROUPS[i % 7]] if i % 7 < len(GROUPS) else []
+
+
+def write_local_db(dbpath, count):
+    local_dir = os.path.join(dbpath, 'local')
+    os.makedirs(local_dir)
+    with open(os.path.join(local_dir, 'ALPM_DB_VERSION'), 'w') as f:
+        f.write('9\n')
+    for i in range(count):
+        name = package_name(i)
+        package_dir = os.path.join(local_dir, '%s-1.0-1' % name)
+        os.mkdir(package_dir)
+        desc = '%%NAME%%\n%s\n\n%%VERSION%%\n1.0-1\n\n' % name
+        if package_groups(i):
+            desc += '%%GROUPS%%\n%s\n\n' % package_groups(i)[0]
+        if i % 3 == 0:
+            desc += '%REASON%\n1\n\n'
+        if i > 0:
+            desc += '%%DEPENDS%%\n%s\n\n' % package_name(i // 2)
+        with open(os.path.join(package_dir, 'desc'), 'w') as f:
+            f.write(desc)
+
+
+def write_sync_dbs(dbpath, count):
+    sync_dir = os.path.join(dbpath, 'sync')
+    os.makedirs(sync_dir)
+    repos = ['core', 'extra', 'community']
+    tars = [tarfile.open(os.path.join(sync_dir, '%s.db' % r), 'w:gz')
+            for r in repos]
+    for i in range(count):
+        name = package_name(i)
+        desc = ('%%FILENAME%%\n%s-1.0-1-x86_64.pkg.tar.xz\n\n'
+                '%%NAME%%\n%s\n\n%%VERSION%%\n1.0-1\n\n'
+                '%%PROVIDES%%\n%s-provider=1.0\n\n' % (name, name, name))
+        if package_groups(i):
+            desc += '%%GROUPS%%\n%s\n\n' % package_groups(i)[0]
+        info = tarfile.TarInfo('%s-1.0-1/desc' % name)
+        info.size = len(desc)
+        tars[i % len(tars)].addfile(info, StringIO.StringIO(desc))
+    for tar in tars:
+        tar.close()
+
+
+def write_config_set(root, count):
+    """Creates `count` config files, a fifth of them inside one large
+    directory entry, and returns the `config_files` dict for them. A third
+    of the system files differ from their backups."""
+    configs_dir = os.path.join(root, 'config_files')
+    system_dir = os.path.join(root, 'system')
+    large_dir = count // 5
+    os.makedirs(os.path.join(configs_dir, 'large'))
+    os.makedirs(os.path.join(system_dir, 'large'))
+
+    config_files = {'large': os.path.join(system_dir, 'large')}
+    for i in range(count):
+        content = ('setting%d = %d\n' % (i, i)) * 50
+        if i < large_dir:
+            name = os.path.join('large', 'file%05d' % i)
+        else:
+            name = 'file%05d' % i
+            config_files[name] = os.path.join(system_dir, name)
+        with open(os.path.join(configs_dir, name), 'w') as f:
+            f.write(content)
+        with open(os.path.join(system_dir, name), 'w') as f:
+            f.write(content if i % 3 else content.upper())
+    return configs_dir, config_files
+
+
+class Benchmark:
+    def __init__(self, repeat):
+        self.repeat = repeat
+        self.results = []
+
+    def run(self, name, size, func, setup=None):
+        """Times `func`, running `setup` untimed before each repetition, and
+        records the fastest run"""
+        times = []
+        for _ in range(self.repeat):
+            if setup is not None:
+                setup()
+            stdout = sys.stdout
+            sys.stdout = open(os.devnull, 'w')
+            try:
+                start = time.time()
+                func()
+                times.append(time.time() - start)
+            finally:
+                sys.stdout = stdout
+        result = {'name': name, 'size': size, 'seconds': min(times),
+                  'repeat': self.repeat}
+        self.results.append(result)
+        print '%-32s %7d %10.4fs' % (name, size, result['seconds'])
+        sys.stdout.flush()
+
+
+def bench_packages(bench, tmp_dir, count):
+    dbpath = os.path.join(tmp_dir, 'db-%d' % count)
+    write_local_db(dbpath, count)
+    write_sync_dbs(dbpath, count)
+
+    # List half of the packages and a few that only exist in the AUR
+    listed = [package_name(i) for i in range(0, count, 2)]
+    aur = ['aur-package%d' % i for i in range(20)]
+    packages = {'listed': listed, 'aur': aur}
+    with open(os.environ['FAKE_PACMAN_PACKAGES'], 'w') as f:
+        f.write('\n'.join(aur) + '\n')
+    archutil.config = Config(packages, {})
+
+    bench.run('list', count, lambda: ListHandler(dbpath)
+              .get_differing_packages(['listed'], False))
+    bench.run('list --inverse', count, lambda: ListHandler(dbpath)
+              .get_differing_packages(['listed'], True))
+    logfile = os.path.join(dbpath, 'pacman.log')
+    with open(logfile, 'w') as f:
+        f.write('[2015-08-01T10:00:00+0000] [ALPM] installed %s (1.0-1)\n'
+                % package_name(0))
+    bench.run('list --incremental', count, lambda: ListHandler(
+        dbpath, logfile).get_differing_packages(['listed'], False))
+    bench.run('list --deps', count, lambda: ListHandler(dbpath)
+              .get_dependency_report(['listed']))
+
+    cache_dir = os.path.join(tmp_dir, 'cache')
+    install_handler = InstallHandler('pacman', dbpath)
+    bench.run('install verify (cold cache)', count,
+              lambda: install_handler.check_packages_exist(
+                  packages, ['listed']),
+              lambda: shutil.rmtree(cache_dir, True))
+    bench.run('install verify (warm cache)', count,
+              lambda: install_handler.check_packages_exist(
+                  packages, ['listed']))
+
+    config_path = os.path.join(tmp_dir, 'config-%d.py' % count)
+    with open(config_path, 'w') as f:
+        f.write('cache_config = True\npackages = %r\nconfig_files = {}\n'
+                % packages)
+    bench.run('load config', count,
+              lambda: archutil.load_config(config_path, False))
+    bench.run('load config (cached)', count,
+              lambda: archutil.load_config(config_path))
+
+    aur_handler = InstallHandler('fake-aur-helper', dbpath)
+    bench.run('install verify (AUR helper)', count,
+              lambda: aur_handler.check_packages_exist(
+                  packages, ['listed', 'aur']))
+
+
+def bench_configs(bench, tmp_dir, count):
+    root = os.path.join(tmp_dir, 'configs-%d' % count)
+    configs_dir, config_files = write_config_set(root, count)
+    manifest_path = os.path.join(root, 'manifest')
+    install_dir = os.path.join(root, 'install')
+
+    def config_diff(manifest):
+        handler = ConfigHandler(configs_dir, manifest)
+        return list(handler.config_diff(configs_dir, config_files))
+
+    bench.run('config -d', count, lambda: config_diff(None))
+    bench.run('config -d (cold manifest)', count,
+              lambda: config_diff(ConfigManifest(manifest_path)),
+              lambda: os.path.exists(manifest_path)
+              and os.remove(manifest_path))
+    bench.run('config -d (warm manifest)', count,
+              lambda: config_diff(ConfigManifest(manifest_path)))
+
+    # Install into a fresh copy of the system files so every run does the
+    # same amount of work
+    installed_files = dict((k, v.replace(os.path.join(root, 'system'),
+                                         install_dir))
+                           for k, v in config_files.iteritems())
+
+    def reset_install_dir():
+        shutil.rmtree(install_dir, True)
+        shutil.copytree(os.path.join(root, 'system'), install_dir)
+
+    def install():
+        handler = ConfigHandler(configs_dir)
+        handler.install_config_files(
+            handler.config_diff(configs_dir, installed_files))
+
+    bench.run('config -i', count, install, reset_install_dir)
+
+    update_dir = os.path.join(root, 'update')
+
+    def reset_update_dir():
+        shutil.rmtree(update_dir, True)
+        shutil.copytree(configs_dir, update_dir)
+        sys.stdin = StringIO.StringIO('y\n' * count)
+
+    def update():
+        handler = ConfigHandler(update_dir)
+        handler.update_config_files(
+            handler.config_diff(update_dir, config_files))
+
+    stdin = sys.stdin
+    try:
+        bench.run('config -u', count, update, reset_update_dir)
+    finally:
+        sys.stdin = stdin
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, old_path):
+    old = dict(((r['name'], r['size']), r['seconds'])
+               for r in json.load(open(old_path))['results'])
+    print
+    print '%-32s %7s %10s %10s %8s' % ('benchmark', 'size', 'old', 'new',
+                                       'speedup')
+    for r in results:
+        key = (r['name'], r['size'])
+        if key in old:
+            print '%-32s %7d %9.4fs %9.4fs %7.2fx' % (
+                r['name'], r['size'], old[key], r['seconds'],
+                old[key] / max(r['seconds'], 1e-9))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='archutil benchmarks')
+    parser.add_argument('--packages', type=int, nargs='+',
+                        default=[500, 5000, 50000],
+                        help='Package database sizes to benchmark')
+    parser.add_argument('--files', type=int, nargs='+',
+                        default=[10, 1000, 10000],
+                        help='Config file set sizes to benchmark')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Runs per benchmark, the fastest is reported')
+    parser.add_argument('-o', '--output', help='Write JSON results here')
+    parser.add_argument('--compare',
+                        help='JSON results of an earlier run to compare with')
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp(prefix='archutil-bench-')
+    environ = dict(os.environ)
+    try:
+        bin_dir = os.path.join(tmp_dir, 'bin')
+        os.mkdir(bin_dir)
+        for name in ('pacman', 'fake-aur-helper'):
+            with open(os.path.join(bin_dir, name), 'w') as f:
+                f.write(FAKE_PACMAN)
+            os.chmod(os.path.join(bin_dir, name), 0755)
+        os.environ['PATH'] = bin_dir + os.pathsep + os.environ['PATH']
+        os.environ['FAKE_PACMAN_PACKAGES'] = os.path.join(tmp_dir, 'aur')
+        os.environ['XDG_CACHE_HOME'] = os.path.join(tmp_dir, 'cache')
+
+        bench = Benchmark(args.repeat)
+        for count in args.packages:
+            bench_packages(bench, tmp_dir, count)
+        for count in args.files:
+            bench_configs(bench, tmp_dir, count)
+    finally:
+        os.environ.clear()
+        os.environ.update(environ)
+        shutil.rmtree(tmp_dir)
+
+    output = {'commit': get_commit(), 'python': platform.python_version(),
+              'time': time.time(), 'results': bench.results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2, sort_keys=True)
+    if args.compare:
+        compare(bench.results, args.compare)
+
+if __name__ == '__main__':
+    main()
@@ -1,15 +1,26 @@
 #!/usr/bin/env python2
 
+import argparse
 import filecmp
+import gzip
+import hashlib
+import json
 import os
 import shutil
+import socket
 import StringIO
 import subprocess
 import sys
+import tarfile
+import tempfile
+import time
 import unittest
 
 sys.path.insert(1, os.path.join(sys.path[0], '..'))
-from archutil import ConfigHandler, InstallHandler, ListHandler
+import archutil
+from archutil import (AURResolver, ConfigHandler, ConfigManifest,
+                      InstallHandler, ListHandler, LocalPackageDB, Prefetcher,
+                      SyncPackageDB)
 DiffResult = ConfigHandler.DiffResult
 
 chroot_message = ('an ArchLinux chroot called "chroot" must be present in the '
@@ -68,6 +79,948 @@ class TestListFunctions(unittest.TestCase):
         os.chdir(self.cwd)
 
 
+def write_local_package(dbpath, name, version, reason=None, groups=(),
+                        depends=(), provides=()):
+    package_dir = os.path.join(dbpath, 'local', '%s-%s' % (name, version))
+    os.makedirs(package_dir)
+    desc = '%%NAME%%\n%s\n\n%%VERSION%%\n%s\n\n' % (name, version)
+    for field, values in (('GROUPS', groups), ('DEPENDS', depends),
+                          ('PROVIDES', provides)):
+        if values:
+            desc += '%%%s%%\n%s\n\n' % (field, '\n'.join(values))
+    if reason is not None:
+        desc += '%%REASON%%\n%d\n\n' % reason
+    with open(os.path.join(package_dir, 'desc'), 'w') as f:
+        f.write(desc)
+
+
+class TestLocalPackageDB(unittest.TestCase):
+    def setUp(self):
+        self.config = archutil.config
+        self.dbpath = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.dbpath, 'local'))
+        open(os.path.join(self.dbpath, 'local', 'ALPM_DB_VERSION'), 'w')
+        write_local_package(self.dbpath, 'bash', '4.3-1', groups=['base'],
+                            depends=['readline>=6.0'], provides=['sh'])
+        write_local_package(self.dbpath, 'gcc', '5.2-1', groups=['base-devel'],
+                            depends=['gcc-libs=5.2-1'])
+        write_local_package(self.dbpath, 'make', '4.1-1', groups=['base-devel'],
+                            depends=['sh'])
+        write_local_package(self.dbpath, 'wget', '1.16-1')
+        write_local_package(self.dbpath, 'readline', '6.3-1', reason=1)
+        write_local_package(self.dbpath, 'gcc-libs', '5.2-1')
+        write_local_package(self.dbpath, 'libxml2', '2.9-1', reason=1)
+
+    def test_index(self):
+        index = LocalPackageDB(self.dbpath)
+        assert index.packages['wget'].version == '1.16-1'
+        assert index.explicit_packages() == set(['bash', 'gcc', 'gcc-libs',
+                                                 'make', 'wget'])
+        assert index.groups() == set(['base', 'base-devel'])
+        assert index.group_members(['base-devel']) == set(['gcc', 'make'])
+
+    def test_list(self):
+        list_handler = ListHandler(self.dbpath)
+        assert list_handler.get_listed_groups(['base-devel', 'vim']) \
+            == ['base-devel']
+        package_list = list_handler.get_installed_packages(['base'])
+        assert package_list == set(['gcc', 'gcc-libs', 'make', 'wget'])
+
+    def test_dependency_report(self):
+        index = LocalPackageDB(self.dbpath)
+        assert index.reverse_dependencies()['bash'] == set(['make'])
+        assert index.dependency_closure(['make']) == set(['bash', 'readline'])
+
+        archutil.config = archutil.Config({'packages': {
+            'base': ['base', 'wget'], 'dev': ['base-devel']}})
+        report = ListHandler(self.dbpath).get_dependency_report(
+            ['base', 'dev'])
+        assert report['redundant'] == {'bash': ['make']}
+        assert report['implied'] == {'gcc-libs': ['gcc']}
+        assert report['orphans'] == {'libxml2': []}
+        assert report['closures'] == {
+            'base': ['bash', 'readline', 'wget'],
+            'dev': ['bash', 'gcc', 'gcc-libs', 'make', 'readline']}
+
+    def test_pending_packages(self):
+        state = archutil.InstallState(os.path.join(self.dbpath, 'state'))
+        packages = {'base': ['base', 'bash'], 'dev': ['gcc', 'vim', 'sh'],
+                    'net': ['wget']}
+        install_handler = InstallHandler('pacman', self.dbpath)
+        assert install_handler.get_pending_packages(
+            packages, ['base', 'dev', 'net'], state) == {
+                'base': ['base'], 'dev': ['vim'], 'net': []}
+
+        state.record(packages, ['base', 'dev', 'net'])
+        state = archutil.InstallState(os.path.join(self.dbpath, 'state'))
+        packages['net'].append('curl')
+        assert install_handler.get_pending_packages(
+            packages, ['base', 'dev', 'net'], state) == {
+                'dev': ['vim'], 'net': ['curl']}
+
+        # Unchanged categories are skipped once everything is installed
+        write_local_package(self.dbpath, 'vim', '7.4-1')
+        assert install_handler.get_pending_packages(
+            packages, ['dev'], state) == {}
+
+    def test_json_output(self):
+        archutil.config = archutil.Config({'packages': {'all': ['bash']}})
+        args = argparse.Namespace(categories=None, deps=False, inverse=False,
+                                  list=False)
+        stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        try:
+            archutil.output = archutil.Output('json')
+            ListHandler(self.dbpath).handle(args)
+            archutil.print_msg('done', archutil.colors.RED)
+            archutil.output.close()
+            records = json.loads(sys.stdout.getvalue())
+        finally:
+            sys.stdout = stdout
+            archutil.output = archutil.Output()
+        assert records[0] == {'type': 'package', 'name': 'gcc',
+                              'status': 'not listed'}
+        assert [r['name'] for r in records[:-1]] == ['gcc', 'gcc-libs',
+                                                     'make', 'wget']
+        assert records[-1] == {'type': 'message', 'message': 'done',
+                               'level': 'error'}
+
+    def test_incremental_index(self):
+        logfile = os.path.join(self.dbpath, 'pacman.log')
+        cache_path = os.path.join(self.dbpath, 'snapshot')
+        with open(logfile, 'w') as f:
+            f.write('[2015-08-01 10:00] [ALPM] installed wget (1.16-1)\n')
+
+        def load():
+            return archutil.IncrementalLocalPackageDB(self.dbpath, logfile,
+                                                      cache_path)
+        assert load().rescanned
+
+        shutil.rmtree(os.path.join(self.dbpath, 'local', 'wget-1.16-1'))
+        write_local_package(self.dbpath, 'wget', '1.17-1', reason=1)
+        write_local_package(self.dbpath, 'vim', '7.4-1')
+        shutil.rmtree(os.path.join(self.dbpath, 'local', 'libxml2-2.9-1'))
+        with open(logfile, 'a') as f:
+            f.write('[2015-08-02T10:00:00+0000] [ALPM] upgraded wget '
+                    '(1.16-1 -> 1.17-1)\n'
+                    '[2015-08-02T10:00:00+0000] [PACMAN] synchronizing\n'
+                    '[2015-08-02T10:00:01+0000] [ALPM] installed vim (7.4-1)\n'
+                    '[2015-08-02T10:00:02+0000] [ALPM] removed libxml2 '
+                    '(2.9-1)\n[2015-08-02T10:00:03+0000] [ALPM] ins')
+        index = load()
+        assert not index.rescanned
+        assert sorted(index.packages) == sorted(
+            LocalPackageDB(self.dbpath).packages)
+        assert index.packages['wget'].version == '1.17-1'
+        assert not index.packages['wget'].explicit
+        assert not load().rescanned
+
+        # A rotated log means transactions may have been missed
+        with open(logfile, 'w') as f:
+            f.write('')
+        assert load().rescanned
+
+    def tearDown(self):
+        archutil.config = self.config
+        shutil.rmtree(self.dbpath)
+
+
+def write_sync_db(path, packages):
+    """Writes a sync database containing `packages`, a list of (name,
+    version, groups, provides) tuples"""
+    tar = tarfile.open(path, 'w:gz')
+    for name, version, groups, provides in packages:
+        desc = '%%NAME%%\n%s\n\n%%VERSION%%\n%s\n\n' % (name, version)
+        if groups:
+            desc += '%%GROUPS%%\n%s\n\n' % '\n'.join(groups)
+        if provides:
+            desc += '%%PROVIDES%%\n%s\n\n' % '\n'.join(provides)
+        info = tarfile.TarInfo('%s-%s/desc' % (name, version))
+        info.size = len(desc)
+        tar.addfile(info, StringIO.StringIO(desc))
+    tar.close()
+
+
+class TestSyncPackageDB(unittest.TestCase):
+    def setUp(self):
+        self.dbpath = tempfile.mkdtemp()
+        self.cache_path = os.path.join(self.dbpath, 'cache')
+        os.makedirs(os.path.join(self.dbpath, 'sync'))
+        write_sync_db(os.path.join(self.dbpath, 'sync', 'core.db'),
+                      [('bash', '4.3-1', ['base'], ['sh']),
+                       ('gcc', '5.2-1', ['base-devel'], [])])
+        write_sync_db(os.path.join(self.dbpath, 'sync', 'extra.db'),
+                      [('wget', '1.16-1', [], []),
+                       ('jre8-openjdk', '8.u60-1', [], ['java-runtime=8'])])
+
+    def test_index(self):
+        index = SyncPackageDB(self.dbpath, self.cache_path)
+        assert index.names == set(['bash', 'gcc', 'wget', 'jre8-openjdk'])
+        assert index.groups == set(['base', 'base-devel'])
+        assert index.provides == set(['sh', 'java-runtime'])
+        assert os.path.isfile(self.cache_path)
+
+        # A second load must come from the cache without reading the tarballs
+        def fail(path):
+            raise AssertionError('%s was read again' % path)
+        original_read_db = SyncPackageDB.read_db
+        SyncPackageDB.read_db = lambda self, path: fail(path)
+        try:
+            assert SyncPackageDB(self.dbpath, self.cache_path).names \
+                == index.names
+        finally:
+            SyncPackageDB.read_db = original_read_db
+
+    def test_check_packages_exist(self):
+        os.environ['XDG_CACHE_HOME'] = self.dbpath
+        install_handler = InstallHandler('pacman', self.dbpath)
+        packages = {'all': ['wget', 'base-devel', 'java-runtime', 'nope']}
+        assert install_handler.check_packages_exist(packages, ['all']) \
+            == set(['nope'])
+
+    def test_should_update_repos(self):
+        install_handler = InstallHandler('pacman', self.dbpath)
+        assert install_handler.should_update_repos()[0]
+        assert not install_handler.should_update_repos(False, 60)[0]
+        assert not install_handler.should_update_repos(None, 60)[0]
+
+        os.utime(os.path.join(self.dbpath, 'sync', 'core.db'), (1, 1))
+        assert install_handler.should_update_repos(None, 60)[0]
+
+        # The databases keep the mirror's mtime after an update
+        os.environ['XDG_CACHE_HOME'] = self.dbpath
+        install_handler.record_sync()
+        assert not install_handler.should_update_repos(None, 60)[0]
+        os.utime(archutil.get_sync_stamp_path(self.dbpath), (1, 1))
+        assert install_handler.should_update_repos(None, 60)[0]
+
+    def tearDown(self):
+        os.environ.pop('XDG_CACHE_HOME', None)
+        shutil.rmtree(self.dbpath)
+
+
+class TestMtreeScanner(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        os.environ['XDG_CACHE_HOME'] = os.path.join(self.root, 'cache')
+        dbpath = archutil.get_dbpath(self.root)
+        os.makedirs(os.path.join(dbpath, 'local'))
+        write_local_package(dbpath, 'vim', '7.4-1')
+        os.makedirs(os.path.join(self.root, 'etc'))
+        mtree = '#mtree\n/set type=file uid=0 gid=0 mode=644\n'
+        for name, shipped, current in (('same', 'a', 'a'),
+                                       ('touched', 'a', 'a'),
+                                       ('edited', 'a', 'b'),
+                                       ('grown', 'a', 'ab'),
+                                       ('with space', 'a', 'b')):
+            path = os.path.join(self.root, 'etc', name)
+            with open(path, 'w') as f:
+                f.write(current)
+            os.utime(path, (1000, 1000 if name == 'same' else 2000))
+            mtree += './etc/%s time=1000.0 size=%d sha256digest=%s\n' % (
+                name.replace(' ', '\\040'), len(shipped),
+                hashlib.sha256(shipped).hexdigest())
+        mtree += './etc type=dir mode=755\n./usr/bin/vim mode=755 size=1\n'
+        f = gzip.open(os.path.join(dbpath, 'local', 'vim-7.4-1', 'mtree'), 'w')
+        f.write(mtree)
+        f.close()
+
+    def test_scan(self):
+        expected = [(os.path.join(self.root, 'etc', name), 'vim', reason)
+                    for name, reason in (('edited', 'sha256'),
+                                         ('grown', 'size'),
+                                         ('with space', 'sha256'))]
+        assert archutil.MtreeScanner(self.root, processes=1).scan() \
+            == expected
+
+        original_hash_file_sha256 = archutil.hash_file_sha256
+        archutil.hash_file_sha256 = None
+        try:
+            assert archutil.MtreeScanner(self.root, processes=1).scan() \
+                == expected
+        finally:
+            archutil.hash_file_sha256 = original_hash_file_sha256
+
+    def test_scan_handler(self):
+        original_config = archutil.config
+        archutil.config = archutil.Config({
+            'packages': {}, 'config_files': {'grown': '/etc/grown'}})
+        missing = os.path.join(self.root, 'missing')
+        args = argparse.Namespace(scan_prefix=['/etc'])
+        stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        try:
+            archutil.output = archutil.Output('jsonl')
+            archutil.ScanHandler([self.root, missing]).handle(args)
+            records = [json.loads(line)
+                       for line in sys.stdout.getvalue().splitlines()]
+        finally:
+            sys.stdout = stdout
+            archutil.output = archutil.Output()
+            archutil.config = original_config
+        assert [os.path.basename(r['path']) for r in records
+                if r['type'] == 'scan'] == ['edited', 'with space']
+        assert records[-1]['level'] == 'error'
+        assert records[-1]['message'].startswith(missing + ': ')
+
+    def test_scan_without_configs_dir(self):
+        config_path = os.path.join(self.root, 'config.py')
+        with open(config_path, 'w') as f:
+            f.write('packages = {}\nconfig_files = {}\n')
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              '..', 'archutil.py')
+        output = subprocess.check_output(
+            [sys.executable, script, '-c', config_path, '--no-config-cache',
+             '--format', 'jsonl', 'config', '--scan', '-r', self.root])
+        records = [json.loads(line) for line in output.splitlines()]
+        assert [os.path.basename(r['path']) for r in records
+                if r['type'] == 'scan'] == ['edited', 'grown', 'with space']
+
+    def tearDown(self):
+        os.environ.pop('XDG_CACHE_HOME', None)
+        shutil.rmtree(self.root)
+
+
+class TestTracer(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def test_trace(self):
+        tracer = archutil.Tracer()
+        tracer.enabled = True
+        with tracer.phase('check'):
+            tracer.call(subprocess.call, ['sh', '-c', 'exit 3'])
+            assert tracer.call(subprocess.check_output,
+                               ['sh', '-c', 'echo hi']) == 'hi\n'
+        tracer.record_command(['sudo', '/usr/bin/pacman', '-S', 'vim'],
+                              time.time(), 0)
+        tracer.record_command(['sudo', 'pacman', '-S', 'git'], time.time(), 1)
+
+        path = os.path.join(self.tmp_dir, 'trace.json')
+        tracer.write_trace(path)
+        with open(path) as f:
+            events = json.load(f)['traceEvents']
+        assert [e['name'] for e in events] == [
+            'sh -c exit 3', 'sh -c echo hi', 'check',
+            'sudo /usr/bin/pacman -S vim', 'sudo pacman -S git']
+        assert all(e['ph'] == 'X' and e['ts'] >= 0 and e['dur'] >= 0
+                   for e in events)
+        assert [e['args'].get('exit_code') for e in events] == [3, 0, None, 0,
+                                                                1]
+        # Calls fall within their phase, give or take the rounding to whole
+        # microseconds
+        check = events[2]
+        assert all(check['ts'] <= e['ts'] + 1 and e['ts'] + e['dur']
+                   <= check['ts'] + check['dur'] + 2 for e in events[:2])
+
+        stderr = sys.stderr
+        sys.stderr = StringIO.StringIO()
+        try:
+            tracer.print_summary()
+            rows = [(line[:40].strip(), line[40:].split()) for line in
+                    sys.stderr.getvalue().split('\n')[1:-2]]
+        finally:
+            sys.stderr = stderr
+        # Operands are left out, so calls of the same program and options
+        # are one row
+        assert [(name, columns[0]) for name, columns in rows] == [
+            ('check', '1'), ('sh -c', '2'), ('sudo pacman -S', '2')]
+        assert rows[1][1][2:] == ['0,3', '3']
+        assert rows[2][1][2] == '0,1'
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+
+class TestPipeline(unittest.TestCase):
+    def test_run(self):
+        pipeline = archutil.Pipeline()
+        pipeline.add('a', lambda: 1)
+        pipeline.add('b', lambda: 2)
+        pipeline.add('sum', lambda a, b: a + b, deps=['a', 'b'])
+        assert pipeline.run() == {'a': 1, 'b': 2, 'sum': 3}
+
+    def test_cancel(self):
+        ran = []
+
+        def fail():
+            time.sleep(0.1)
+            raise archutil.PipelineFailed('failed')
+
+        pipeline = archutil.Pipeline()
+        pipeline.add('fail', fail)
+        pipeline.add('slow', lambda: archutil.tracer.communicate(
+            ['sleep', '10']))
+        pipeline.add('after', lambda _: ran.append(True), deps=['slow'])
+        start = time.time()
+        self.assertRaises(archutil.PipelineFailed, pipeline.run)
+        assert time.time() - start < 5
+        assert not ran
+        # Later pipelines aren't affected
+        assert archutil.tracer.communicate(['true'])[0] == 0
+
+
+class TestPacmanConfig(unittest.TestCase):
+    def setUp(self):
+        self.config = archutil.config
+        self.tmp_dir = tempfile.mkdtemp()
+        os.environ['XDG_CACHE_HOME'] = self.tmp_dir
+        self.path = os.path.join(self.tmp_dir, 'pacman.conf')
+        os.mkdir(os.path.join(self.tmp_dir, 'repos.d'))
+        self.include = os.path.join(self.tmp_dir, 'repos.d', 'custom.conf')
+        with open(self.path, 'w') as f:
+            f.write('[options]\nRootDir = /mnt\nCacheDir = /a /b\n'
+                    'CacheDir = /c # comment\n\n[core]\nInclude = %s\n\n'
+                    '#[multilib]\n#Include = /etc/pacman.d/mirrorlist\n'
+                    'Include = %s/repos.d/*.conf\n'
+                    % (os.path.join(self.tmp_dir, 'mirrorlist'), self.tmp_dir))
+        with open(self.include, 'w') as f:
+            f.write('[custom]\nServer = file:///srv/repo\n')
+
+    def test_parse(self):
+        pacman_config = archutil.PacmanConfig(self.path)
+        assert pacman_config.repos == [('core', True), ('multilib', False),
+                                       ('custom', True)]
+        assert pacman_config.dbpath == '/mnt/var/lib/pacman'
+        assert pacman_config.cache_dirs == ['/a', '/b', '/c']
+
+        original_parse = archutil.PacmanConfig.parse
+        archutil.PacmanConfig.parse = None
+        try:
+            assert archutil.PacmanConfig(self.path).enabled_repos() == [
+                'core', 'custom']
+        finally:
+            archutil.PacmanConfig.parse = original_parse
+
+        # Changing an included file invalidates the cache
+        with open(self.include, 'w') as f:
+            f.write('#[custom]\n')
+        os.utime(self.include, (1, 1))
+        pacman_config = archutil.PacmanConfig(self.path)
+        assert pacman_config.enabled_repos() == ['core']
+
+        archutil.config = archutil.Config({'required_repos': ['core',
+                                                              'custom']})
+        install_handler = InstallHandler('pacman',
+                                         pacman_config=pacman_config)
+        assert install_handler.dbpath == '/mnt/var/lib/pacman'
+        assert install_handler.check_required_repos() == ['custom']
+
+    def tearDown(self):
+        archutil.config = self.config
+        os.environ.pop('XDG_CACHE_HOME', None)
+        shutil.rmtree(self.tmp_dir)
+
+
+class TestAURResolver(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        os.environ['XDG_CACHE_HOME'] = self.tmp_dir
+        self.snapshot = os.path.join(self.tmp_dir, 'packages-meta-v1.json')
+        with open(self.snapshot, 'w') as f:
+            f.write('[{"Name": "yay", "Provides": null},'
+                    ' {"Name": "neovim-git", "Provides": ["neovim=0.1"]}]')
+        self.helper = os.path.join(self.tmp_dir, 'helper')
+        with open(self.helper, 'w') as f:
+            f.write('#!/bin/sh\n[ "$2" = cower ] && echo cower-git && '
+                    'echo cower\nexit 0\n')
+        os.chmod(self.helper, 0755)
+
+    def test_resolve(self):
+        resolver = AURResolver(self.helper, self.snapshot, jobs=2)
+        bad_packages = resolver.resolve(['yay', 'neovim', 'cower', 'nope'])
+        assert bad_packages == ['nope']
+        assert resolver.timings['yay'][0] == 'snapshot'
+        assert resolver.timings['neovim'][0] == 'snapshot'
+        assert resolver.timings['cower'][0] == self.helper
+
+    def test_unreadable_snapshot(self):
+        with open(self.snapshot, 'w') as f:
+            f.write('[{"Name": "yay"')
+        for path in (self.snapshot, os.path.join(self.tmp_dir, 'missing')):
+            resolver = AURResolver(self.helper, path)
+            assert resolver.resolve(['yay', 'cower']) == ['yay']
+            assert resolver.timings['cower'][0] == self.helper
+
+    def tearDown(self):
+        os.environ.pop('XDG_CACHE_HOME', None)
+        shutil.rmtree(self.tmp_dir)
+
+
+class TestLoadConfig(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        os.environ['XDG_CACHE_HOME'] = self.tmp_dir
+
+    def test_json_config(self):
+        path = os.path.join(self.tmp_dir, 'config.json')
+        with open(path, 'w') as f:
+            f.write('{"packages": {"all": ["vim"]}, "pacman": "yaourt",'
+                    ' "config_files": {"vimrc": "/home/user/.vimrc"}}')
+        for _ in range(2):
+            c = archutil.load_config(path)
+            assert c.packages == {'all': ['vim']}
+            assert type(c.pacman) == str
+
+    def test_python_config_cache(self):
+        path = os.path.join(self.tmp_dir, 'config.py')
+        with open(path, 'w') as f:
+            f.write('cache_config = True\npackages = {}\nconfig_files = {}\n')
+        archutil.load_config(path)
+
+        original_read_config_file = archutil.read_config_file
+        archutil.read_config_file = None
+        try:
+            assert archutil.load_config(path).packages == {}
+        finally:
+            archutil.read_config_file = original_read_config_file
+
+        # Uncached configs are executed every time
+        with open(path, 'w') as f:
+            f.write('packages = {"all": []}\nconfig_files = {}\n')
+        assert archutil.load_config(path).packages == {'all': []}
+        assert not isinstance(archutil.load_config(path), archutil.Config)
+
+    def tearDown(self):
+        os.environ.pop('XDG_CACHE_HOME', None)
+        shutil.rmtree(self.tmp_dir)
+
+
+class TestConfigTransaction(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.configs_dir = os.path.join(self.tmp_dir, 'config_files')
+        self.system_dir = os.path.join(self.tmp_dir, 'system')
+        os.makedirs(os.path.join(self.configs_dir, 'dir'))
+        os.makedirs(os.path.join(self.system_dir, 'dir'))
+        for name in ('vimrc', 'dir/a'):
+            with open(os.path.join(self.configs_dir, name), 'w') as f:
+                f.write('new')
+            os.utime(os.path.join(self.configs_dir, name), (0, 0))
+            with open(os.path.join(self.system_dir, name), 'w') as f:
+                f.write('old')
+        self.journal_path = os.path.join(self.tmp_dir, 'journal')
+
+    def read(self, name):
+        with open(os.path.join(self.system_dir, name)) as f:
+            return f.read()
+
+    def test_atomic_install(self):
+        handler = ConfigHandler(self.configs_dir,
+                                journal_path=self.journal_path)
+        config_files = {'vimrc': os.path.join(self.system_dir, 'vimrc'),
+                        'dir': os.path.join(self.system_dir, 'dir')}
+        handler.atomic_install_config_files(
+            handler.config_diff(self.configs_dir, config_files))
+        assert self.read('vimrc') == self.read('dir/a') == 'new'
+        assert self.read('vimrc.bak') == self.read('../system/dir.bak/a') \
+            == 'old'
+        assert sorted(os.listdir(self.system_dir)) == ['dir', 'dir.bak',
+                                                       'vimrc', 'vimrc.bak']
+        assert not os.path.exists(self.journal_path)
+
+    def test_recover(self):
+        system_config = os.path.join(self.system_dir, 'vimrc')
+        transaction = archutil.ConfigTransaction(self.journal_path)
+        transaction.stage(os.path.join(self.configs_dir, 'vimrc'),
+                          system_config)
+        transaction.journal.close()
+        assert archutil.ConfigTransaction.recover(self.journal_path) == 'back'
+        assert sorted(os.listdir(self.system_dir)) == ['dir', 'vimrc']
+        assert self.read('vimrc') == 'old'
+
+        transaction = archutil.ConfigTransaction(self.journal_path)
+        transaction.stage(os.path.join(self.configs_dir, 'vimrc'),
+                          system_config)
+        transaction.journal.write('commit\n')
+        transaction.journal.close()
+        assert archutil.ConfigTransaction.recover(self.journal_path) \
+            == 'forward'
+        assert self.read('vimrc') == 'new'
+        assert archutil.ConfigTransaction.recover(self.journal_path) is None
+
+    def test_symlink(self):
+        link = os.path.join(self.system_dir, 'link')
+        os.symlink('vimrc', link)
+        transaction = archutil.ConfigTransaction(self.journal_path)
+        transaction.stage(os.path.join(self.configs_dir, 'vimrc'), link)
+        transaction.commit()
+        assert os.readlink(link) == 'vimrc'
+        assert self.read('vimrc') == 'new'
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+
+class TestConfigPlan(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.configs_dir = os.path.join(self.tmp_dir, 'config_files')
+        self.system_dir = os.path.join(self.tmp_dir, 'system')
+        os.mkdir(self.configs_dir)
+        os.mkdir(self.system_dir)
+        for name, backup, system in (('same', 'x', 'x'), ('a.conf', 'b', 's'),
+                                     ('b.txt', 'b', 's'),
+                                     ('system_only', None, 's'),
+                                     ('backup_only', 'b', None)):
+            for root, content in ((self.configs_dir, backup),
+                                  (self.system_dir, system)):
+                if content is not None:
+                    with open(os.path.join(root, name), 'w') as f:
+                        f.write(content)
+        self.config_files = dict(
+            (name, os.path.join(self.system_dir, name))
+            for name in ('same', 'a.conf', 'b.txt', 'system_only',
+                         'backup_only'))
+        self.plan_path = os.path.join(self.tmp_dir, 'plan.json')
+
+    def read(self, root, name):
+        with open(os.path.join(root, name)) as f:
+            return f.read()
+
+    def test_plan_and_apply(self):
+        handler = ConfigHandler(self.configs_dir,
+                                policy_rules=[('*.conf', 'backup')])
+        handler.write_plan(self.plan_path, handler.config_diff(
+            self.configs_dir, self.config_files))
+        with open(self.plan_path) as f:
+            actions = dict((e['name'], e['action'])
+                           for e in json.load(f)['entries'])
+        assert actions == {'same': 'skip', 'a.conf': 'install',
+                           'b.txt': 'conflict', 'system_only': 'update',
+                           'backup_only': 'install'}
+
+        # Files changed after planning are left alone
+        with open(os.path.join(self.system_dir, 'system_only'), 'w') as f:
+            f.write('changed')
+        ConfigHandler(self.configs_dir, policy_rules=[('*', 'system')]) \
+            .apply_plan(self.plan_path)
+        assert self.read(self.system_dir, 'a.conf') == 'b'
+        assert self.read(self.configs_dir, 'b.txt') == 's'
+        assert self.read(self.system_dir, 'backup_only') == 'b'
+        assert not os.path.exists(os.path.join(self.configs_dir,
+                                               'system_only'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+
+class TestBackupStore(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.configs_dir = os.path.join(self.tmp_dir, 'config_files')
+        self.system_dir = os.path.join(self.tmp_dir, 'system')
+        os.makedirs(os.path.join(self.configs_dir, 'dir'))
+        os.makedirs(os.path.join(self.system_dir, 'dir'))
+        for name in ('vimrc', 'dir/a', 'dir/b'):
+            for root, content in ((self.configs_dir, 'new'),
+                                  (self.system_dir, 'old')):
+                with open(os.path.join(root, name), 'w') as f:
+                    f.write(content)
+            os.utime(os.path.join(self.configs_dir, name), (0, 0))
+        self.store = archutil.BackupStore(
+            archutil.get_backup_store_path(self.configs_dir))
+
+    def read(self, name):
+        with open(os.path.join(self.system_dir, name)) as f:
+            return f.read()
+
+    def test_install_and_restore(self):
+        handler = ConfigHandler(self.configs_dir, backup_store=self.store)
+        config_files = {'vimrc': os.path.join(self.system_dir, 'vimrc'),
+                        'dir': os.path.join(self.system_dir, 'dir')}
+        with open(os.path.join(self.system_dir, 'dir', 'b'), 'w') as f:
+            f.write('old!')
+        handler.install_config_files(
+            handler.config_diff(self.configs_dir, config_files))
+        assert sorted(os.listdir(self.system_dir)) == ['dir', 'vimrc']
+        assert self.read('dir/b') == 'new'
+
+        # 'old' is only stored once
+        snapshot_id, = self.store.snapshot_ids()
+        assert len(self.store.load_snapshot(snapshot_id)['files']) == 3
+        assert sum(len(files) for _, _, files
+                   in os.walk(self.store.objects_dir)) == 2
+
+        assert self.store.restore(snapshot_id, [self.system_dir + '/dir']) \
+            == [os.path.join(self.system_dir, 'dir', n) for n in 'ab']
+        assert self.read('dir/a') == 'old' and self.read('dir/b') == 'old!'
+        assert self.read('vimrc') == 'new'
+        assert len(self.store.snapshot_ids()) == 2
+
+        # The newest snapshot refers to 'new' only
+        assert self.store.gc(keep=1) == (1, 2)
+        assert self.store.gc() == (0, 0)
+
+    def test_restore_symlink(self):
+        link = os.path.join(self.system_dir, 'link')
+        os.symlink('vimrc', link)
+        self.store.backup(link)
+        snapshot_id = self.store.save_snapshot()
+        with open(link, 'w') as f:
+            f.write('new')
+        assert self.store.restore(snapshot_id, [link]) == [
+            os.path.realpath(os.path.join(self.system_dir, 'vimrc'))]
+        assert os.readlink(link) == 'vimrc'
+        assert self.read('vimrc') == 'old'
+
+    def test_rolled_back_install(self):
+        handler = ConfigHandler(
+            self.configs_dir, journal_path=os.path.join(self.tmp_dir, 'journal'),
+            backup_store=self.store)
+
+        def results():
+            for r in handler.config_diff(self.configs_dir, {
+                    'vimrc': os.path.join(self.system_dir, 'vimrc')}):
+                yield r
+            raise RuntimeError('interrupted')
+        self.assertRaises(RuntimeError, handler.atomic_install_config_files,
+                          results())
+        assert self.read('vimrc') == 'old'
+        assert self.store.snapshot_ids() == []
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+
+class TestPatternExpander(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.system_dir = os.path.join(self.tmp_dir, 'system')
+        self.configs_dir = os.path.join(self.tmp_dir, 'config_files')
+        for path in ('system/app.conf', 'system/a/b/nested.conf',
+                     'system/a/notes.txt', 'system/cache/skip.conf',
+                     'config_files/dotconfig/a/backup_only.conf'):
+            path = os.path.join(self.tmp_dir, path)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            open(path, 'w').close()
+
+    def test_compile_pattern(self):
+        regex = archutil.compile_pattern('**/[!x]*.conf')
+        assert regex.match('a.conf') and regex.match('a/b/c.conf')
+        assert not regex.match('x.conf') and not regex.match('a.confx')
+        assert not archutil.compile_pattern('*.conf').match('a/b.conf')
+
+    def test_expand(self):
+        cache_path = os.path.join(self.tmp_dir, 'cache')
+        config_files = {'dotconfig': self.system_dir + '/**/*.conf',
+                        'bashrc': '~/.bashrc'}
+
+        def expand():
+            return archutil.PatternExpander(['cache'], cache_path).expand(
+                self.configs_dir, config_files)
+        expected = {'bashrc': os.path.expanduser('~/.bashrc')}
+        for rel in ('app.conf', 'a/b/nested.conf', 'a/backup_only.conf'):
+            expected[os.path.join('dotconfig', rel)] = os.path.join(
+                self.system_dir, rel)
+        assert expand() == expected
+
+        original_walk_tree = archutil.walk_tree
+        archutil.walk_tree = None
+        try:
+            assert expand() == expected
+        finally:
+            archutil.walk_tree = original_walk_tree
+
+        # New files change their directory's mtime
+        open(os.path.join(self.system_dir, 'a', 'new.conf'), 'w').close()
+        os.utime(os.path.join(self.system_dir, 'a'), (0, 0))
+        assert 'dotconfig/a/new.conf' in expand()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+
+class TestFleetHandler(unittest.TestCase):
+    def setUp(self):
+        self.config = archutil.config
+        self.tmp_dir = tempfile.mkdtemp()
+        self.roots = [os.path.join(self.tmp_dir, name)
+                      for name in ('vm1', 'vm2', 'missing')]
+        for root, packages in zip(self.roots[:2], (['vim', 'git'],
+                                                   ['vim', 'emacs'])):
+            dbpath = archutil.get_dbpath(root)
+            os.makedirs(os.path.join(dbpath, 'local'))
+            for p in packages:
+                write_local_package(dbpath, p, '1.0-1')
+            os.makedirs(os.path.join(root, 'etc'))
+            with open(os.path.join(root, 'etc', 'vimrc'), 'w') as f:
+                f.write(root)
+        self.configs_dir = os.path.join(self.tmp_dir, 'config_files')
+        os.mkdir(self.configs_dir)
+        with open(os.path.join(self.configs_dir, 'vimrc'), 'w') as f:
+            f.write(self.roots[0])
+        archutil.config = archutil.Config({
+            'packages': {'all': ['vim', 'zsh']},
+            'config_files': {'vimrc': '/etc/vimrc'}})
+
+    def test_reports(self):
+        fleet = archutil.FleetHandler(self.roots)
+        report = fleet.list_report(['all'], False)
+        assert report['roots'] == {self.roots[0]: ['git'],
+                                   self.roots[1]: ['emacs']}
+        assert self.roots[2] in report['errors']
+        assert report['common'] == []
+        assert fleet.list_report(['all'], True)['common'] == ['zsh']
+
+        report = archutil.FleetHandler(self.roots[:2]).config_report(
+            self.configs_dir, 1)
+        assert report['roots'][self.roots[0]] == []
+        assert report['roots'][self.roots[1]] == [
+            os.path.join(self.roots[1], 'etc/vimrc') + ' differs from '
+            + os.path.join(self.configs_dir, 'vimrc')]
+        assert report['common'] == []
+
+    def test_roots_file(self):
+        path = os.path.join(self.tmp_dir, 'roots')
+        with open(path, 'w') as f:
+            f.write('# images\n/mnt/vm1\n\n/mnt/vm2  # staging\n')
+        assert archutil.read_roots_file(path) == ['/mnt/vm1', '/mnt/vm2']
+
+    def tearDown(self):
+        archutil.config = self.config
+        shutil.rmtree(self.tmp_dir)
+
+
+class TestDaemon(unittest.TestCase):
+    def setUp(self):
+        # Daemon.reload_config replaces the global config
+        self.config = archutil.config
+        self.tmp_dir = tempfile.mkdtemp()
+        os.environ['XDG_CACHE_HOME'] = self.tmp_dir
+        self.dbpath = os.path.join(self.tmp_dir, 'db')
+        os.makedirs(os.path.join(self.dbpath, 'local'))
+        write_local_package(self.dbpath, 'vim', '7.4-1')
+        self.configs_dir = os.path.join(self.tmp_dir, 'config_files')
+        os.mkdir(self.configs_dir)
+        with open(os.path.join(self.configs_dir, 'vimrc'), 'w') as f:
+            f.write('set number\n')
+        self.system_path = os.path.join(self.tmp_dir, 'vimrc')
+        self.config_path = os.path.join(self.tmp_dir, 'config.json')
+        with open(self.config_path, 'w') as f:
+            f.write('{"packages": {"all": ["vim", "git"]},'
+                    ' "config_files": {"vimrc": "%s"}}' % self.system_path)
+
+    def test_query(self):
+        daemon = archutil.Daemon(self.config_path, self.configs_dir,
+                                 self.dbpath)
+        assert daemon.query('ping') == 'pong'
+        assert daemon.query('list -i') == 'git'
+        assert daemon.query('config -d') == self.system_path + \
+            ' does not exist'
+        assert self.tmp_dir in daemon.watched_paths()
+
+        # Cached state is kept until its paths change
+        write_local_package(self.dbpath, 'git', '2.6-1')
+        assert daemon.query('list -i') == 'git'
+        daemon.invalidate(os.path.join(self.dbpath, 'local', 'git-2.6-1'))
+        assert daemon.query('list -i') == ''
+
+        shutil.copy(os.path.join(self.configs_dir, 'vimrc'), self.system_path)
+        daemon.invalidate(self.system_path)
+        assert daemon.query('config -d').endswith(' matches ' + os.path.join(
+            self.configs_dir, 'vimrc'))
+
+    def test_watched_pattern_dirs(self):
+        system_dir = os.path.join(self.tmp_dir, 'zsh')
+        os.makedirs(os.path.join(system_dir, 'a', 'b'))
+        os.makedirs(os.path.join(self.configs_dir, 'zsh', 'c'))
+        with open(self.config_path, 'w') as f:
+            f.write('{"packages": {}, "config_files": {"zsh": "%s/**/*.zsh"}}'
+                    % system_dir)
+        daemon = archutil.Daemon(self.config_path, self.configs_dir,
+                                 self.dbpath)
+        watched = daemon.watched_paths()
+        for path in (system_dir, os.path.join(system_dir, 'a', 'b'),
+                     os.path.join(self.configs_dir, 'zsh', 'c')):
+            assert path in watched
+
+    def tearDown(self):
+        archutil.config = self.config
+        os.environ.pop('XDG_CACHE_HOME', None)
+        shutil.rmtree(self.tmp_dir)
+
+
+class TestPrefetcher(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.mirror = os.path.join(self.tmp_dir, 'mirror')
+        self.cache_dir = os.path.join(self.tmp_dir, 'cache')
+        os.makedirs(self.mirror)
+        os.makedirs(self.cache_dir)
+        self.files = ['wget-1.16-1-x86_64.pkg.tar.xz',
+                      'libidn-1.32-1-x86_64.pkg.tar.xz']
+        for name in self.files:
+            with open(os.path.join(self.mirror, name), 'w') as f:
+                f.write(name)
+
+        # pacman -Sp prints the URL of every package on the local mirror
+        self.bin_dir = os.path.join(self.tmp_dir, 'bin')
+        os.makedirs(self.bin_dir)
+        self.write_pacman('for f in %s/*; do echo file://$f; done' % self.mirror)
+        self.path = os.environ['PATH']
+        os.environ['PATH'] = self.bin_dir + os.pathsep + self.path
+
+    def write_pacman(self, script):
+        with open(os.path.join(self.bin_dir, 'pacman'), 'w') as f:
+            f.write('#!/bin/sh\n%s\n' % script)
+        os.chmod(os.path.join(self.bin_dir, 'pacman'), 0755)
+
+    def test_prefetch(self):
+        prefetcher = Prefetcher([self.cache_dir], jobs=2)
+        assert sorted(prefetcher.prefetch(['wget'])) == sorted(self.files)
+        assert sorted(os.listdir(self.cache_dir)) == sorted(self.files)
+        assert prefetcher.install_options() == []
+
+        # Cached packages aren't downloaded again
+        assert Prefetcher([self.cache_dir]).prefetch(['wget']) == []
+
+    def test_failed_download(self):
+        missing = 'gone-1.0-1-x86_64.pkg.tar.xz'
+        self.write_pacman('echo file://%s/%s; echo file://%s/%s' % (
+            self.mirror, self.files[0], self.mirror, missing))
+        prefetcher = Prefetcher([self.cache_dir], jobs=2)
+        assert prefetcher.prefetch(['wget']) == [self.files[0]]
+        assert prefetcher.errors.keys() == [missing]
+        assert os.listdir(self.cache_dir) == [self.files[0]]
+
+        # A mirror that accepts the connection but never answers times out
+        server = socket.socket()
+        server.bind(('127.0.0.1', 0))
+        server.listen(1)
+        try:
+            self.write_pacman('echo http://127.0.0.1:%d/%s'
+                              % (server.getsockname()[1], missing))
+            prefetcher = Prefetcher([self.cache_dir], timeout=0.2)
+            start = time.time()
+            assert prefetcher.prefetch(['gone']) == []
+            assert time.time() - start < 5
+            assert prefetcher.errors.keys() == [missing]
+        finally:
+            server.close()
+        assert os.listdir(self.cache_dir) == [self.files[0]]
+
+        # A failing pacman -Sp leaves every download to the install
+        dbpath = os.path.join(self.tmp_dir, 'db')
+        os.makedirs(os.path.join(dbpath, 'local'))
+        os.makedirs(os.path.join(dbpath, 'sync'))
+        write_sync_db(os.path.join(dbpath, 'sync', 'core.db'),
+                      [('vim', '7.4-1', [], [])])
+        self.write_pacman('exit 1')
+        os.environ['XDG_CACHE_HOME'] = self.tmp_dir
+        try:
+            assert InstallHandler('pacman', dbpath).prefetch(
+                {'all': ['vim']}, ['all'], 2) == \
+                Prefetcher().install_options()
+        finally:
+            os.environ.pop('XDG_CACHE_HOME', None)
+
+    def tearDown(self):
+        os.environ['PATH'] = self.path
+        shutil.rmtree(self.tmp_dir)
+
+
 class TestConfigFunctions(unittest.TestCase):
     cwd = os.path.dirname(os.path.abspath(__file__))
     install_ref_dir = os.path.join(cwd, 'install_ref_dir')
@@ -128,12 +1081,60 @@ class TestConfigFunctions(unittest.TestCase):
 
         for f, r in zip(files, expected_results):
             config_files = {os.path.basename(f): f}
-            result = self.config_handler.config_diff(self.config_dir, config_files)[0]
+            result = next(self.config_handler.config_diff(self.config_dir,
+                                                          config_files))
             r.backup_config_path = os.path.join(self.config_dir,
                                                 os.path.basename(f))
             r.system_config_path = f
             assert result == r
 
+    def test_parallel_imap_lookahead(self):
+        started = []
+
+        def func(i):
+            started.append(i)
+            return i
+        results = archutil.parallel_imap(func, range(20), 2)
+        assert next(results) == 0
+        time.sleep(0.1)
+        assert sorted(started) == [0, 1, 2]
+        assert list(results) == range(1, 20)
+
+    def test_parallel_config_diff(self):
+        names = ['f%02d' % i for i in range(12)]
+        config_files = {}
+        for name in reversed(names):
+            for path in (os.path.join(self.config_dir, name),
+                         os.path.join(self.test_dir, name)):
+                with open(path, 'w') as f:
+                    f.write(name)
+            config_files[name] = os.path.join(self.test_dir, name)
+        config_handler = ConfigHandler(self.config_dir, jobs=4)
+
+        # Results come out in name order however long each comparison takes
+        original_diff_entry = config_handler.diff_entry
+
+        def diff_entry(backup_config_path, system_config_path):
+            time.sleep(0.01 * (len(names) - names.index(
+                os.path.basename(backup_config_path))))
+            return original_diff_entry(backup_config_path, system_config_path)
+        config_handler.diff_entry = diff_entry
+        results = list(config_handler.config_diff(self.config_dir,
+                                                  config_files))
+        assert [os.path.basename(r.backup_config_path) for r in results] \
+            == names
+        assert all(r.result == DiffResult.MATCHES for r in results)
+
+        def fail(backup_config_path, system_config_path):
+            if backup_config_path.endswith('f05'):
+                raise ValueError(backup_config_path)
+            return original_diff_entry(backup_config_path, system_config_path)
+        config_handler.diff_entry = fail
+        results = config_handler.config_diff(self.config_dir, config_files)
+        assert [os.path.basename(next(results).backup_config_path)
+                for _ in range(5)] == names[:5]
+        self.assertRaises(ValueError, next, results)
+
     def test_install_config_files(self):
         config_files = {
             os.path.basename(self.bak_matching_config): self.sys_matching_config,
@@ -161,6 +1162,120 @@ class TestConfigFunctions(unittest.TestCase):
 
         self.assert_dirs_equal(self.test_dir, self.update_ref_dir)
 
+    def test_update_json_output(self):
+        config_files = {
+            os.path.basename(self.bak_differing_config): self.sys_differing_config,
+        }
+        results = self.config_handler.config_diff(self.config_dir, config_files)
+
+        old_stdin, stdout, stderr = sys.stdin, sys.stdout, sys.stderr
+        sys.stdin = StringIO.StringIO('y\n')
+        sys.stdout, sys.stderr = StringIO.StringIO(), StringIO.StringIO()
+        try:
+            archutil.output = archutil.Output('jsonl')
+            self.config_handler.update_config_files(results)
+            records = [json.loads(line)
+                       for line in sys.stdout.getvalue().splitlines()]
+            prompt = sys.stderr.getvalue()
+        finally:
+            sys.stdin, sys.stdout, sys.stderr = old_stdin, stdout, stderr
+            archutil.output = archutil.Output()
+        assert 'diff' in [r['type'] for r in records]
+        assert prompt.startswith('Update config file')
+        assert open(self.bak_differing_config).read() == 'a'
+
+    def test_config_diff_manifest(self):
+        config_files = {
+            os.path.basename(self.bak_matching_config): self.sys_matching_config,
+            os.path.basename(self.bak_differing_config): self.sys_differing_config,
+        }
+        manifest = ConfigManifest(os.path.join(self.test_dir, 'manifest'))
+        config_handler = ConfigHandler(self.config_dir, manifest)
+        results = list(config_handler.config_diff(self.config_dir,
+                                                  config_files))
+        assert os.path.isfile(manifest.path)
+
+        # Unchanged files must be classified without reading them
+        original_hash_file = archutil.hash_file
+        archutil.hash_file = None
+        try:
+            manifest = ConfigManifest(manifest.path)
+            config_handler = ConfigHandler(self.config_dir, manifest)
+            assert list(config_handler.config_diff(
+                self.config_dir, config_files)) == results
+        finally:
+            archutil.hash_file = original_hash_file
+
+        with open(self.sys_differing_config, 'w') as f:
+            f.write('b')
+        os.utime(self.sys_differing_config, (1, 1))
+        results = config_handler.config_diff(self.config_dir, config_files)
+        assert all(r.result == DiffResult.MATCHES for r in results)
+
+    def test_diff_output(self):
+        with open(self.sys_differing_config, 'w') as f:
+            f.write('a\n' * 1000)
+        result = DiffResult(True, True, DiffResult.DIFFERS,
+                            self.bak_differing_config,
+                            self.sys_differing_config)
+        output = ''.join(result.iter_diff(100))
+        assert output.startswith('1c1,1000\n< b\n')
+        assert output.endswith('\n[diff truncated after 100 bytes]\n')
+
+        with open(self.sys_differing_config, 'w') as f:
+            f.write('\0\1')
+        assert result.diff_output == 'Binary files %s and %s differ\n' % (
+            self.bak_differing_config, self.sys_differing_config)
+
+    def test_diff_json_output(self):
+        with open(self.sys_differing_config, 'w') as f:
+            f.write('caf\xe9\n')
+        result = DiffResult(True, True, DiffResult.DIFFERS,
+                            self.bak_differing_config,
+                            self.sys_differing_config)
+        stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        try:
+            archutil.output = archutil.Output('jsonl')
+            self.config_handler.print_diff(result)
+            record = json.loads(sys.stdout.getvalue())
+        finally:
+            sys.stdout = stdout
+            archutil.output = archutil.Output()
+        assert record['type'] == 'diff'
+        assert record['diff'].endswith(u'> caf\ufffd\n')
+
+    def test_sync_tree(self):
+        src = os.path.join(self.config_dir, 'vim')
+        dst = os.path.join(self.test_dir, 'vim')
+        for d in (src, dst):
+            os.makedirs(os.path.join(d, 'plugin'))
+            for name, content in (('vimrc', 'set nu'),
+                                  ('plugin/a.vim', 'old')):
+                with open(os.path.join(d, name), 'w') as f:
+                    f.write(content)
+                os.utime(os.path.join(d, name), (1, 1))
+        with open(os.path.join(src, 'plugin/a.vim'), 'w') as f:
+            f.write('new')
+        with open(os.path.join(src, 'plugin/b.vim'), 'w') as f:
+            f.write('b')
+
+        self.config_handler.safe_copy(src, dst)
+        self.assert_dirs_equal(src, dst)
+        assert os.listdir(self.test_dir + '/vim.bak') == ['plugin']
+        assert os.listdir(self.test_dir + '/vim.bak/plugin') == ['a.vim']
+        assert open(self.test_dir + '/vim.bak/plugin/a.vim').read() == 'old'
+
+        # A same-size edit keeping the mtime is still copied
+        with open(os.path.join(src, 'vimrc'), 'w') as f:
+            f.write('set rnu')
+        with open(os.path.join(dst, 'vimrc'), 'w') as f:
+            f.write('set nu!')
+        for d in (src, dst):
+            os.utime(os.path.join(d, 'vimrc'), (1.5, 1.5))
+        self.config_handler.safe_copy(src, dst)
+        assert open(os.path.join(dst, 'vimrc')).read() == 'set rnu'
+
     def tearDown(self):
         shutil.rmtree(self.test_dir)
 